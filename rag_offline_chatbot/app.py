@@ -3,28 +3,163 @@
 # =========================
 import os
 import re  # for cleaning model output
+import math
+import heapq
+import threading
+import time
+import queue
+import atexit
+import hashlib
 from pathlib import Path
-from flask import Flask, request, jsonify, send_from_directory, session
+from flask import (
+    Flask, Response, g, has_app_context, request, jsonify, send_from_directory, session,
+)
 import json
-import requests
-from duckduckgo_search import DDGS
-from collections import deque
+from collections import OrderedDict
 import sqlite3
 from werkzeug.security import generate_password_hash, check_password_hash
-from functools import wraps
+from functools import lru_cache, wraps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+
+# Heavy dependencies (requests, duckduckgo_search, faiss, sentence-transformers)
+# are imported lazily; warm_up() loads them once the server starts.
+_MODULE_STARTED = time.perf_counter()
 
 ROOT = Path(__file__).parent
 DATA_DIR = ROOT / "data"
 INDEX_FILE = DATA_DIR / "faiss_index.idx"
 DOCS_FILE = DATA_DIR / "documents.txt"
+MANIFEST_FILE = DATA_DIR / "manifest.json"
 
 app = Flask(__name__, static_folder="static", static_url_path="/static")
 app.secret_key = "CHANGE_ME_TO_SOMETHING_RANDOM_AND_SECRET"  # CHANGE IN PROD
 
-conversation_memory = deque(maxlen=5)
 
 # --- User database (SQLite) config ---
-USER_DB = "/tmp/users.db"
+USER_DB = os.getenv("USER_DB") or "/tmp/users.db"
+
+
+# ----------------- METRICS -----------------
+# Upper bounds (seconds) of the latency histogram buckets; +Inf is implicit.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metrics:
+    """In-process counters and latency histograms, exported in Prometheus text format.
+
+    inc("name", reason="x") bumps a counter; observe("name", seconds, stage="y")
+    records a latency; span("stage") / timed("stage") time a block or function
+    into bloom_stage_seconds and count exceptions in bloom_stage_errors_total.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters: dict[str, dict[tuple, float]] = {}
+        # name -> label key -> [per-bucket counts..., +Inf count, sum]
+        self._histograms: dict[str, dict[tuple, list]] = {}
+        self._help: dict[str, str] = {}
+
+    def describe(self, name: str, text: str):
+        self._help[name] = text
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            h = series.get(key)
+            if h is None:
+                h = series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    h[i] += 1
+                    break
+            else:
+                h[len(self.buckets)] += 1
+            h[-1] += seconds
+
+    @contextmanager
+    def span(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("bloom_stage_errors_total", stage=stage)
+            raise
+        finally:
+            self.observe("bloom_stage_seconds", time.perf_counter() - started, stage=stage)
+
+    def timed(self, stage: str):
+        """Decorator form of span() for plain (non-generator) functions."""
+        def decorate(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def render(self, gauges: dict[str, float] | None = None) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(key)} {value:g}")
+            for name, series in sorted(self._histograms.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, h in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(self.buckets, h):
+                        cumulative += count
+                        le = 'le="%g"' % bound
+                        lines.append(f"{name}_bucket{_format_labels(key, le)} {cumulative}")
+                    cumulative += h[len(self.buckets)]
+                    le = 'le="+Inf"'
+                    lines.append(f"{name}_bucket{_format_labels(key, le)} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {h[-1]:.6f}")
+                    lines.append(f"{name}_count{_format_labels(key)} {cumulative}")
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("bloom_stage_seconds", "Latency of one pipeline stage.")
+metrics.describe("bloom_stage_errors_total", "Exceptions raised inside a pipeline stage.")
+metrics.describe("bloom_request_seconds", "End-to-end latency of a chat request.")
+metrics.describe("bloom_replies_total", "Chat replies by where the final text came from.")
+metrics.describe("bloom_ollama_failures_total", "Ollama calls that produced no output, by reason.")
+metrics.describe("bloom_low_quality_total", "LLM replies rejected by is_low_quality.")
+metrics.describe("bloom_web_search_total", "Web lookups by outcome.")
+metrics.describe("bloom_prefill_tokens_total", "Prompt tokens Ollama reported evaluating.")
+metrics.describe(
+    "bloom_ollama_flights_total",
+    "Ollama requests by single-flight role: leader (made the call) or merged (shared it).",
+)
 
 
 # ----------------- AUTH DECORATOR -----------------
@@ -38,12 +173,143 @@ def login_required(f):
 
 
 # ----------------- DB HELPERS -----------------
-def get_db_connection():
-    conn = sqlite3.connect(USER_DB)
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS") or 5000)
+DB_CACHED_STATEMENTS = 256
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE") or 8)
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT") or 10)
+
+
+class PooledConnection(sqlite3.Connection):
+    """Connection owned by db_pool that survives the helpers' conn.close() calls.
+
+    close() rolls back an unfinished transaction and returns the connection
+    to the pool once the outermost checkout closes it; release() really
+    closes it.
+    """
+
+    path = None
+    depth = 0
+
+    def close(self):
+        if self.depth <= 0:
+            return
+        self.depth -= 1
+        if self.depth:
+            return
+        if has_app_context() and g.get("_db_conn") is self:
+            g.pop("_db_conn")
+        if self.in_transaction:
+            self.rollback()
+        db_pool.put(self)
+
+    def release(self):
+        super().close()
+
+
+def _open_db_connection(path):
+    conn = sqlite3.connect(
+        path,
+        factory=PooledConnection,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=DB_CACHED_STATEMENTS,
+        check_same_thread=False,  # checked out by whichever thread needs it
+    )
+    conn.path = path
     conn.row_factory = sqlite3.Row
+    # WAL lets readers run alongside the writer; NORMAL skips the per-commit
+    # fsync of the WAL (still safe against app crashes, not power loss).
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
 
+class ConnectionPool:
+    """Bounded set of open USER_DB connections shared by all threads.
+
+    Connections are opened lazily up to `size`; once all are checked out,
+    get() waits up to DB_POOL_TIMEOUT for one to come back. Connections to a
+    previous USER_DB are closed instead of being handed out again.
+    """
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self._idle: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._opened = 0
+
+    def get(self) -> PooledConnection:
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._open_or_wait()
+            if conn.path == USER_DB:
+                conn.depth = 1
+                return conn
+            self._discard(conn)
+
+    def _open_or_wait(self) -> PooledConnection:
+        with self._lock:
+            grow = self._opened < self.size
+            if grow:
+                self._opened += 1
+        if grow:
+            try:
+                return _open_db_connection(USER_DB)
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        try:
+            return self._idle.get(timeout=DB_POOL_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError(
+                f"no database connection free after {DB_POOL_TIMEOUT:g}s"
+            ) from None
+
+    def put(self, conn: PooledConnection):
+        conn.depth = 0
+        if conn.path == USER_DB:
+            self._idle.put(conn)
+        else:
+            self._discard(conn)
+
+    def _discard(self, conn: PooledConnection):
+        conn.release()
+        with self._lock:
+            self._opened -= 1
+
+
+db_pool = ConnectionPool(DB_POOL_SIZE)
+
+
+def get_db_connection():
+    """Check out a pooled connection to USER_DB; conn.close() gives it back.
+
+    Within a request, nested calls share one checkout, and teardown returns
+    it if a handler never closed it.
+    """
+    if not has_app_context():
+        return db_pool.get()
+    conn = g.get("_db_conn")
+    if conn is not None:
+        conn.depth += 1
+        return conn
+    conn = g._db_conn = db_pool.get()
+    return conn
+
+
+@app.teardown_appcontext
+def return_db_connection(exc):
+    conn = g.pop("_db_conn", None)
+    if conn is not None:
+        conn.depth = 1
+        conn.close()
+
+
 def init_user_db():
     """Create users + conversations + messages tables."""
     conn = get_db_connection()
@@ -70,6 +336,10 @@ def init_user_db():
             title TEXT,
             created_at TEXT NOT NULL,
             updated_at TEXT NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            last_message_at TEXT,
+            summary TEXT NOT NULL DEFAULT '',
+            recent_turns TEXT NOT NULL DEFAULT '[]',
             FOREIGN KEY(user_id) REFERENCES users(id)
         )
         """
@@ -77,6 +347,10 @@ def init_user_db():
     cur.execute(
         "CREATE INDEX IF NOT EXISTS idx_conversations_user ON conversations(user_id)"
     )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_updated "
+        "ON conversations(user_id, updated_at)"
+    )
 
     # Messages
     cur.execute(
@@ -100,12 +374,36 @@ def init_user_db():
         "CREATE INDEX IF NOT EXISTS idx_messages_conv_id ON messages(conversation_id, id)"
     )
 
+    # Migration: denormalized per-conversation counters for the sidebar listing.
+    cols = {r["name"] for r in cur.execute("PRAGMA table_info(conversations)")}
+    if "message_count" not in cols:
+        cur.execute(
+            "ALTER TABLE conversations ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0"
+        )
+    if "last_message_at" not in cols:
+        cur.execute("ALTER TABLE conversations ADD COLUMN last_message_at TEXT")
+    if "message_count" not in cols or "last_message_at" not in cols:
+        cur.execute(
+            """
+            UPDATE conversations SET
+                message_count = (SELECT COUNT(1) FROM messages m
+                                 WHERE m.conversation_id = conversations.id),
+                last_message_at = (SELECT MAX(created_at) FROM messages m
+                                   WHERE m.conversation_id = conversations.id)
+            """
+        )
+    # Migration: per-conversation memory (see CONVERSATION MEMORY).
+    if "summary" not in cols:
+        cur.execute("ALTER TABLE conversations ADD COLUMN summary TEXT NOT NULL DEFAULT ''")
+    if "recent_turns" not in cols:
+        cur.execute(
+            "ALTER TABLE conversations ADD COLUMN recent_turns TEXT NOT NULL DEFAULT '[]'"
+        )
+
     conn.commit()
     conn.close()
 
 
-init_user_db()
-
 
 # ----------------- ROUTES TO FRONTENDS -----------------
 @app.route("/")
@@ -124,21 +422,122 @@ def chat_page():
     return send_from_directory("static", "index.html")
 
 
+# ----------------- KEYWORD RULES -----------------
+_TOKEN_RE = re.compile(r"[a-z0-9']+")
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_RE.findall(text.lower().replace("\u2019", "'"))
+
+
+# Every keyword rule the chat pipeline applies to a message, as data.
+# Phrases match whole words; a trailing "*" matches any word starting with
+# the stem ("trauma*" -> trauma, traumatic, traumatized).
+KEYWORD_RULES = {
+    "crisis": ["suicid*", "kill myself", "end my life", "hurt myself"],
+    "live": ["latest", "news", "today", "current*", "update*", "price*", "weather"],
+    "medical": [
+        "symptom*", "cause*", "treatment*", "disease*", "disorder*", "ptsd", "trauma*",
+    ],
+    # detect_emoji
+    "emoji_sad": [
+        "sad", "sadness", "depressed", "hopeless", "cry", "crying", "cried",
+        "lonely", "empty", "tired",
+    ],
+    "emoji_anxious": ["anxious", "panic*", "worried", "scared", "nervous", "overthinking"],
+    "emoji_angry": ["angry", "mad", "furious", "rage", "irritated"],
+    "emoji_happy": ["happy", "excited", "great", "good", "relieved", "peaceful"],
+    # therapy_playbook_reply
+    "playbook_body_image": [
+        "body image", "too fat", "fat", "overweight", "weight", "appearance",
+        "judged", "judgment", "judgement", "look ugly", "look bad",
+    ],
+    "playbook_trauma": ["ptsd", "trauma*", "post traumatic"],
+    "playbook_social_anxiety": [
+        "fear of judgment", "fear of judgement", "being judged", "people judging",
+        "social anxiety",
+    ],
+    "playbook_sleep": [
+        "trouble sleeping", "insomnia", "can't sleep", "cant sleep", "sleep problem*",
+    ],
+    "playbook_help": ["help", "solve", "ways", "how to", "what to do"],
+    # fallback_generate
+    "fallback_eating": [
+        "body image", "eating disorder*", "anorexia", "bulimia", "binge*", "purge*",
+        "disordered eating",
+    ],
+    "fallback_low_mood": ["depressed", "sad", "hopeless", "empty", "lonely", "worthless"],
+    "fallback_anxiety": ["anxious", "panic*", "nervous", "worried", "overthinking"],
+    "fallback_stress": ["stressed", "pressure", "burned out", "overworked"],
+    "fallback_anger": ["angry", "mad", "frustrated", "rage"],
+    "fallback_technical": ["error*", "bug*", "flask", "python", "api", "server*"],
+}
+
+
+class RuleMatcher:
+    """Word-level trie over every rule phrase, compiled once.
+
+    match() tokenizes the message once and walks the trie from each token,
+    so overlapping phrases ("fear of judgment" and "judgment") all count.
+    """
+
+    def __init__(self, rules: dict[str, list[str]]):
+        self.root = self._node()
+        for category, phrases in rules.items():
+            for phrase in phrases:
+                node = self.root
+                for word in phrase.split():
+                    if word.endswith("*"):
+                        node = node["stems"].setdefault(word[:-1], self._node())
+                    else:
+                        node = node["words"].setdefault(word, self._node())
+                node["categories"].add(category)
+
+    @staticmethod
+    def _node():
+        return {"words": {}, "stems": {}, "categories": set()}
+
+    def match(self, text: str) -> frozenset:
+        tokens = tokenize(text)
+        found = set()
+        for i in range(len(tokens)):
+            frontier = [self.root]
+            for tok in tokens[i:]:
+                nxt = []
+                for node in frontier:
+                    child = node["words"].get(tok)
+                    if child is not None:
+                        nxt.append(child)
+                    for stem, child in node["stems"].items():
+                        if tok.startswith(stem):
+                            nxt.append(child)
+                if not nxt:
+                    break
+                for node in nxt:
+                    found |= node["categories"]
+                frontier = nxt
+        return frozenset(found)
+
+
+keyword_matcher = RuleMatcher(KEYWORD_RULES)
+
+
+@lru_cache(maxsize=1024)
+def message_categories(text: str) -> frozenset:
+    """All rule categories hit by a message; computed once per distinct message."""
+    return keyword_matcher.match(text)
+
+
 # ----------------- EMOJI & DOC HELPERS -----------------
 def detect_emoji(text):
-    t = text.lower()
-    sadness = ["sad", "depressed", "hopeless", "cry", "lonely", "empty", "tired"]
-    anxiety = ["anxious", "panic", "worried", "scared", "nervous", "overthinking"]
-    anger = ["angry", "mad", "furious", "rage", "irritated"]
-    happiness = ["happy", "excited", "great", "good", "relieved", "peaceful"]
-
-    if any(w in t for w in sadness):
+    cats = message_categories(text)
+    if "emoji_sad" in cats:
         return "😢"
-    if any(w in t for w in anxiety):
+    if "emoji_anxious" in cats:
         return "😰"
-    if any(w in t for w in anger):
+    if "emoji_angry" in cats:
         return "😡"
-    if any(w in t for w in happiness):
+    if "emoji_happy" in cats:
         return "😊"
     return "💬"
 
@@ -152,18 +551,73 @@ def load_docs():
 
 
 # ---------- Ollama generate with stop tokens + env model ----------
-def generate_with_ollama(prompt, model=None):
-    url = "http://127.0.0.1:11434/api/generate"
+OLLAMA_URL = os.getenv("OLLAMA_URL") or "http://127.0.0.1:11434/api/generate"
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY") or 2)
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv("OLLAMA_QUEUE_TIMEOUT") or 30)
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT") or 3)
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT") or 90)
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX") or 512)
+OLLAMA_NUM_PREDICT = int(os.getenv("OLLAMA_NUM_PREDICT") or 320)
+# How long Ollama keeps the model (and its KV cache) loaded after a call.
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE") or "30m"
+
+
+def _make_ollama_session():
+    """One keep-alive session shared by all requests to the local model server."""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    s = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=max(4, OLLAMA_MAX_CONCURRENCY * 2)
+    )
+    s.mount("http://", adapter)
+    return s
+
+
+ollama_http = None
+_ollama_http_lock = threading.Lock()
+
+
+def get_ollama_http():
+    global ollama_http
+    if ollama_http is None:
+        with _ollama_http_lock:
+            if ollama_http is None:
+                ollama_http = _make_ollama_session()
+    return ollama_http
+
+# Caps in-flight generations; extra callers wait here instead of queueing in Ollama.
+ollama_gate = threading.BoundedSemaphore(OLLAMA_MAX_CONCURRENCY)
+
+
+@contextmanager
+def ollama_slot(wait: float = OLLAMA_QUEUE_TIMEOUT):
+    """Hold one generation slot; yields False if none freed up within `wait` seconds."""
+    started = time.perf_counter()
+    acquired = ollama_gate.acquire(timeout=wait)
+    metrics.observe("bloom_stage_seconds", time.perf_counter() - started, stage="ollama_queue")
+    if not acquired:
+        metrics.inc("bloom_ollama_failures_total", reason="busy")
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            ollama_gate.release()
+
+
+def _ollama_payload(prompt, model=None, stream=False):
     model = (model or os.getenv("OLLAMA_MODEL") or "phi").strip()
     payload = {
         "model": model,
         "prompt": prompt,
-        "stream": False,
+        "stream": stream,
         "raw": True,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
         "options": {
             "temperature": 0.45,
-            "num_ctx": 512,
-            "num_predict": 320,
+            "num_ctx": OLLAMA_NUM_CTX,
+            "num_predict": OLLAMA_NUM_PREDICT,
             "stop": [
                 "\nUSER:",
                 "\nUser:",
@@ -177,17 +631,280 @@ def generate_with_ollama(prompt, model=None):
             ],
         },
     }
-    try:
-        resp = requests.post(url, json=payload, timeout=90)
-        if not getattr(resp, "ok", False):
+    return payload
+
+
+def _record_final(data: dict):
+    """Record prefill stats from Ollama's final message.
+
+    prompt_eval_count only counts tokens Ollama had to evaluate, so prompt
+    prefixes reused from its KV cache show up as a lower count.
+    """
+    if data.get("prompt_eval_duration"):
+        metrics.observe(
+            "bloom_stage_seconds", data["prompt_eval_duration"] / 1e9, stage="ollama_prefill"
+        )
+    if data.get("prompt_eval_count"):
+        metrics.inc("bloom_prefill_tokens_total", data["prompt_eval_count"])
+
+
+class StreamTruncated(Exception):
+    """An Ollama stream failed after some fragments were already yielded."""
+
+
+class _Flight:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pieces: list[str] = []
+        self.done = False
+        self.result = None
+        self.error = None
+        self.readers = 0  # stream() callers still reading
+        self.abandoned = False  # every reader left: stop reading upstream
+
+
+class SingleFlight:
+    """Coalesce concurrent identical calls into one execution.
+
+    The first caller for a key (the leader) runs the call; callers arriving
+    while it is in flight wait for and share its result, or for streams,
+    replay the pieces received so far and then follow live. Nothing is
+    cached after the call finishes; that is the response cache's job.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights: dict[str, _Flight] = {}
+
+    def _join(self, key: str, reader: bool = False) -> tuple[_Flight, bool]:
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leader = True
+            else:
+                leader = False
+            if reader:
+                flight.readers += 1
+        metrics.inc(
+            "bloom_ollama_flights_total", kind=self.name, role="leader" if leader else "merged"
+        )
+        return flight, leader
+
+    def _finish(self, key: str, flight: _Flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        with flight.cond:
+            flight.done = True
+            flight.cond.notify_all()
+
+    def do(self, key: str, fn):
+        flight, leader = self._join(key)
+        if not leader:
+            with flight.cond:
+                flight.cond.wait_for(lambda: flight.done)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            self._finish(key, flight)
+
+    def stream(self, key: str, make_iter):
+        """Generator over make_iter()'s pieces; returns its return value.
+
+        make_iter() is read on a background thread, not by any one caller,
+        so a caller that stops early (stop marker, client gone) does not cut
+        the stream short for the others; every caller replays the pieces so
+        far and then follows live. An exception from make_iter() is raised
+        in every caller after the pieces it produced. Upstream is only
+        closed once no caller is reading any more.
+        """
+        flight, leader = self._join(key, reader=True)
+        if leader:
+            threading.Thread(
+                target=self._pump, args=(key, flight, make_iter),
+                name=f"{self.name}-flight", daemon=True,
+            ).start()
+        seen = 0
+        try:
+            while True:
+                with flight.cond:
+                    flight.cond.wait_for(lambda: flight.done or len(flight.pieces) > seen)
+                    new = flight.pieces[seen:]
+                    finished = flight.done
+                seen += len(new)
+                yield from new
+                if finished:
+                    if flight.error is not None:
+                        raise flight.error
+                    return flight.result
+        finally:
+            self._leave(key, flight)
+
+    def _leave(self, key: str, flight: _Flight):
+        with self._lock:
+            flight.readers -= 1
+            if flight.readers == 0 and not flight.done:
+                # Nobody left to read it: new callers start a fresh flight.
+                flight.abandoned = True
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    def _pump(self, key: str, flight: _Flight, make_iter):
+        it = make_iter()
+        try:
+            while not flight.abandoned:
+                try:
+                    piece = next(it)
+                except StopIteration as stop:
+                    flight.result = stop.value
+                    break
+                with flight.cond:
+                    flight.pieces.append(piece)
+                    flight.cond.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            it.close()
+            self._finish(key, flight)
+
+
+# Keyed on the full request payload (model, prompt, options).
+generate_flights = SingleFlight("generate")
+stream_flights = SingleFlight("stream")
+
+
+def _flight_key(payload: dict) -> str:
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def generate_with_ollama(prompt, model=None, timeout=None, stage="ollama_generate"):
+    """Generate a reply, or None on failure.
+
+    Identical concurrent requests share one Ollama call.
+    """
+    payload = _ollama_payload(prompt, model)
+    timeout = timeout or (OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT)
+    return generate_flights.do(
+        _flight_key(payload), lambda: _generate(payload, timeout, stage)
+    )
+
+
+def _generate(payload, timeout, stage):
+    import requests
+
+    with ollama_slot() as ok:
+        if not ok:
+            print("Ollama busy: no generation slot within", OLLAMA_QUEUE_TIMEOUT, "s")
             return None
-        data = resp.json()
-        return (data.get("response") or "").strip()
-    except requests.exceptions.ConnectionError:
-        return None
-    except requests.exceptions.Timeout:
-        return None
-    except Exception:
+        reason = None
+        try:
+            with metrics.span(stage):
+                resp = get_ollama_http().post(OLLAMA_URL, json=payload, timeout=timeout)
+                if not getattr(resp, "ok", False):
+                    reason = f"http_{getattr(resp, 'status_code', 'error')}"
+                    return None
+                data = resp.json()
+                _record_final(data)
+                return (data.get("response") or "").strip()
+        except requests.exceptions.ConnectionError:
+            reason = "connection"
+            return None
+        except requests.exceptions.Timeout:
+            reason = "timeout"
+            return None
+        except Exception as e:
+            reason = "error"
+            print("Ollama error:", e)
+            return None
+        finally:
+            if reason:
+                metrics.inc("bloom_ollama_failures_total", reason=reason)
+
+
+def stream_with_ollama(prompt, model=None, timeout=None):
+    """Yield response fragments as Ollama emits them. Yields nothing on failure.
+
+    Raises StreamTruncated if Ollama fails mid-reply. Identical concurrent
+    requests share one Ollama stream.
+    """
+    payload = _ollama_payload(prompt, model, stream=True)
+    timeout = timeout or (OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT)
+    yield from stream_flights.stream(_flight_key(payload), lambda: _stream(payload, timeout))
+
+
+def _stream(payload, timeout):
+    """Generator over Ollama's response fragments.
+
+    A call that fails before the first fragment just ends; one that fails
+    after raises StreamTruncated, so a partial reply is never taken for a
+    finished one.
+    """
+    import requests
+
+    with ollama_slot() as ok:
+        if not ok:
+            print("Ollama busy: no generation slot within", OLLAMA_QUEUE_TIMEOUT, "s")
+            return None
+        started = time.perf_counter()
+        first = True
+        final = False
+        reason = None
+        try:
+            with get_ollama_http().post(
+                OLLAMA_URL, json=payload, stream=True, timeout=timeout
+            ) as resp:
+                if not getattr(resp, "ok", False):
+                    metrics.inc(
+                        "bloom_ollama_failures_total",
+                        reason=f"http_{getattr(resp, 'status_code', 'error')}",
+                    )
+                    return None
+                for line in resp.iter_lines():
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    piece = data.get("response") or ""
+                    if piece:
+                        if first:
+                            first = False
+                            metrics.observe(
+                                "bloom_stage_seconds",
+                                time.perf_counter() - started,
+                                stage="ollama_first_token",
+                            )
+                        yield piece
+                    if data.get("done"):
+                        # Keep reading to the end of the body so the pooled
+                        # connection can be reused.
+                        _record_final(data)
+                        final = True
+                if final:
+                    return None
+                reason = "truncated"  # connection closed before the final message
+        except requests.exceptions.Timeout:
+            reason = "timeout"
+        except requests.exceptions.RequestException:
+            reason = "connection"
+        except Exception as e:
+            reason = "error"
+            print("Ollama stream error:", e)
+        finally:
+            # Ends early when every reader has stopped (stop marker or client gone).
+            metrics.observe(
+                "bloom_stage_seconds", time.perf_counter() - started, stage="ollama_stream"
+            )
+        metrics.inc("bloom_ollama_failures_total", reason=reason)
+        if not first:
+            raise StreamTruncated(reason)
         return None
 
 
@@ -217,6 +934,60 @@ def clean_llm_output(s: str) -> str:
     return s.strip()
 
 
+_PREFIX_RE = re.compile(r"^\s*(ASSISTANT:|Assistant:|RESPONSE:|Response:)\s*")
+
+
+class StreamingCleaner:
+    """Incremental version of clean_llm_output for streamed generations.
+
+    Text is only released once it can no longer be the start of a cut
+    marker; after a marker is seen the stream is marked as stopped.
+    """
+
+    _HOLD = max(len(m) for m in _LABEL_CUT_MARKERS) - 1
+    _PREFIX_LEN = 10  # longest prefix stripped by _PREFIX_RE
+
+    def __init__(self):
+        self.buf = ""
+        self.emitted = 0
+        self.stopped = False
+        self._prefix_done = False
+
+    def _release(self, end: int) -> str:
+        if not self._prefix_done:
+            m = _PREFIX_RE.match(self.buf)
+            self.emitted = m.end() if m else len(self.buf) - len(self.buf.lstrip())
+            self._prefix_done = True
+        if end <= self.emitted:
+            return ""
+        out = self.buf[self.emitted:end]
+        self.emitted = end
+        return out
+
+    def feed(self, chunk: str) -> str:
+        if self.stopped:
+            return ""
+        start = max(0, self.emitted - self._HOLD)
+        self.buf += chunk
+        cut = -1
+        for m in _LABEL_CUT_MARKERS:
+            i = self.buf.find(m, start)
+            if i != -1 and (cut == -1 or i < cut):
+                cut = i
+        if cut != -1:
+            self.stopped = True
+            return self._release(cut)
+        if not self._prefix_done and len(self.buf.lstrip()) < self._PREFIX_LEN:
+            return ""
+        return self._release(len(self.buf) - self._HOLD)
+
+    def finish(self) -> str:
+        if self.stopped:
+            return ""
+        self.stopped = True
+        return self._release(len(self.buf)).rstrip()
+
+
 def remove_question_echo(user_msg: str, response: str) -> str:
     """Drop lines that just restate the user's question."""
     if not response:
@@ -251,25 +1022,10 @@ def is_low_quality(user_msg: str, response: str) -> bool:
 
 # ---------- Offline therapy playbook (strong fallback) ----------
 def therapy_playbook_reply(user_msg: str) -> str | None:
-    t = user_msg.lower()
+    cats = message_categories(user_msg)
 
     # Body image / fear of judgement
-    if any(
-        k in t
-        for k in [
-            "body image",
-            "too fat",
-            "fat",
-            "overweight",
-            "weight",
-            "appearance",
-            "judged",
-            "judgment",
-            "judgement",
-            "look ugly",
-            "look bad",
-        ]
-    ):
+    if "playbook_body_image" in cats:
         return (
             "I hear how heavy this feels—fearing judgment about your body can be exhausting.\n"
             "- Name the inner critic → label those thoughts as thoughts, not facts.\n"
@@ -282,7 +1038,7 @@ def therapy_playbook_reply(user_msg: str) -> str | None:
         )
 
     # PTSD / trauma coping
-    if "ptsd" in t or "trauma" in t or "post traumatic" in t:
+    if "playbook_trauma" in cats:
         return (
             "Thanks for reaching out—coping with trauma is hard, and you’re not alone.\n"
             "- Grounding: 5-4-3-2-1 with senses; pair with slow exhale (6s) breaths.\n"
@@ -294,16 +1050,7 @@ def therapy_playbook_reply(user_msg: str) -> str | None:
         )
 
     # Social anxiety / fear of judgment
-    if any(
-        k in t
-        for k in [
-            "fear of judgment",
-            "fear of judgement",
-            "being judged",
-            "people judging",
-            "social anxiety",
-        ]
-    ):
+    if "playbook_social_anxiety" in cats:
         return (
             "That fear of being judged can feel intense—I get it.\n"
             "- Prediction test: write your feared outcome; run a tiny exposure; compare prediction vs outcome.\n"
@@ -314,16 +1061,7 @@ def therapy_playbook_reply(user_msg: str) -> str | None:
         )
 
     # Sleep difficulties
-    if any(
-        k in t
-        for k in [
-            "trouble sleeping",
-            "insomnia",
-            "can't sleep",
-            "cant sleep",
-            "sleep problem",
-        ]
-    ):
+    if "playbook_sleep" in cats:
         return (
             "Sleep trouble is rough—here are bite-size steps:\n"
             "- Consistent wake time; light exposure within an hour of waking.\n"
@@ -333,10 +1071,7 @@ def therapy_playbook_reply(user_msg: str) -> str | None:
         )
 
     # General “help me” support
-    if any(
-        k in t
-        for k in ["help", "solve", "ways", "how to", "what to do"]
-    ):
+    if "playbook_help" in cats:
         return (
             "Let’s make this practical:\n"
             "- Name the problem in one sentence; pick one tiny next step.\n"
@@ -349,91 +1084,510 @@ def therapy_playbook_reply(user_msg: str) -> str | None:
 
 
 def fallback_generate(user_msg):
-    t = user_msg.lower()
-    if any(
-        w in t
-        for w in [
-            "body image",
-            "eating disorder",
-            "anorexia",
-            "bulimia",
-            "binge",
-            "purge",
-            "disordered eating",
-        ]
-    ):
+    cats = message_categories(user_msg)
+    if "fallback_eating" in cats:
         return (
             "Thank you for sharing that—body image and eating concerns can feel heavy. "
             "If it helps, we can talk about what you’ve been experiencing, any triggers you notice, and small steps for support. "
             "If symptoms affect your health or daily life, consider speaking with a licensed professional for tailored care."
         )
-    if any(
-        w in t for w in ["depressed", "sad", "hopeless", "empty", "lonely", "worthless"]
-    ):
+    if "fallback_low_mood" in cats:
         return (
             "I'm really sorry you're feeling this low. Depression can make everything feel heavy and exhausting. "
             "If possible, try to talk to someone you trust or consider reaching out to a counselor."
         )
-    if any(
-        w in t for w in ["anxious", "panic", "nervous", "worried", "overthinking"]
-    ):
+    if "fallback_anxiety" in cats:
         return (
             "Feeling anxious can be overwhelming. Try slowing your breathing — in for 4, hold for 4, out for 6. "
             "You're safe right now; grounding steps can help calm your system."
         )
-    if any(
-        w in t for w in ["stressed", "pressure", "burned out", "overworked"]
-    ):
+    if "fallback_stress" in cats:
         return (
             "Stress builds up fast. Even small breaks, stretching, or stepping away briefly can help. "
             "It's okay to slow down when things feel overwhelming."
         )
-    if any(w in t for w in ["angry", "mad", "frustrated", "rage"]):
+    if "fallback_anger" in cats:
         return (
             "It sounds like you're feeling very frustrated or angry. "
             "Taking a moment to breathe and step back can help you regain balance."
         )
-    if any(w in t for w in ["error", "bug", "flask", "python", "api", "server"]):
+    if "fallback_technical" in cats:
         return "Share the exact error message and I’ll help fix it."
     return "I’m here with you. Tell me more about what you're feeling."
 
 
-def retrieve_context(query):
+# ----------------- VECTOR RETRIEVAL -----------------
+EMBED_MODEL_NAME = os.getenv("EMBED_MODEL") or "all-MiniLM-L6-v2"
+RAG_TOP_K = 3
+
+
+def _index_search_params() -> str:
     try:
-        docs = load_docs()
-        if not docs:
-            return ""
-        words = set(query.lower().split())
-        scored = []
-        for d in docs:
-            dwords = set(d.lower().split())
-            score = len(words & dwords)
-            scored.append((score, d))
-        scored.sort(reverse=True, key=lambda x: x[0])
-        top = [d for s, d in scored if s > 0][:3]
+        manifest = json.loads(MANIFEST_FILE.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return ""
+    return (manifest.get("index") or {}).get("search_params", "")
+
+
+class VectorRetriever:
+    """FAISS index + embedding model kept resident for the life of the process."""
+
+    def __init__(self, index, docs, model):
+        self.index = index
+        self.docs = docs
+        self.model = model
+
+    @classmethod
+    def load(cls, docs=None, model=None):
+        """Load the index (and docs/model unless given); None if anything is missing."""
+        if not (INDEX_FILE.exists() and DOCS_FILE.exists()):
+            return None
+        try:
+            import faiss
+            from sentence_transformers import SentenceTransformer
+        except Exception as e:
+            print("Vector retrieval disabled (missing dependency):", e)
+            return None
+        try:
+            index = faiss.read_index(str(INDEX_FILE))
+            if docs is None:
+                docs = load_docs()
+            if index.ntotal != len(docs):
+                print(
+                    f"Vector retrieval disabled: index has {index.ntotal} vectors "
+                    f"but {len(docs)} documents. Re-run build_index.py."
+                )
+                return None
+            params = _index_search_params()
+            if params:
+                # IVF nprobe / HNSW efSearch chosen at build time (build_index.py --index)
+                faiss.ParameterSpace().set_index_parameters(index, params)
+            if model is None:
+                model = SentenceTransformer(EMBED_MODEL_NAME)
+        except Exception as e:
+            print("Vector retrieval disabled:", e)
+            return None
+        return cls(index, docs, model)
+
+    def search(self, query: str, k: int = RAG_TOP_K) -> list[str]:
+        import faiss
+
+        q = self.model.encode([query], convert_to_numpy=True).astype("float32")
+        faiss.normalize_L2(q)  # index stores L2-normalized vectors (cosine via IP)
+        k = min(k, self.index.ntotal)
+        if k <= 0:
+            return []
+        _, ids = self.index.search(q, k)
+        return [self.docs[i] for i in ids[0] if 0 <= i < len(self.docs)]
+
+
+# ----------------- KEYWORD RETRIEVAL (BM25) -----------------
+class BM25Index:
+    """Okapi BM25 over an inverted index built once from the corpus.
+
+    postings maps term -> [(doc_id, term_freq), ...]; a query only visits
+    the postings of its own terms and keeps the best k with a heap.
+    """
+
+    def __init__(self, docs: list[str], k1: float = 1.5, b: float = 0.75):
+        self.docs = docs
+        self.k1 = k1
+        self.b = b
+        self.postings: dict[str, list[tuple[int, int]]] = {}
+        self.doc_len: list[int] = []
+        for doc_id, doc in enumerate(docs):
+            tf: dict[str, int] = {}
+            for tok in tokenize(doc):
+                tf[tok] = tf.get(tok, 0) + 1
+            self.doc_len.append(sum(tf.values()))
+            for term, freq in tf.items():
+                self.postings.setdefault(term, []).append((doc_id, freq))
+        n = len(docs)
+        avgdl = (sum(self.doc_len) / n) if n else 0.0
+        # Precompute idf per term and the length norm per doc.
+        self.idf = {
+            term: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5))
+            for term, p in self.postings.items()
+        }
+        self.norm = [
+            k1 * (1 - b + b * (dl / avgdl if avgdl else 0.0)) for dl in self.doc_len
+        ]
+
+    def search(self, query: str, k: int = RAG_TOP_K) -> list[str]:
+        scores: dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf[term]
+            for doc_id, freq in postings:
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * (
+                    freq * (self.k1 + 1) / (freq + self.norm[doc_id])
+                )
+        best = heapq.nlargest(k, scores.items(), key=lambda x: x[1])
+        return [self.docs[doc_id] for doc_id, _ in best]
+
+
+# ----------------- CORPUS STORE -----------------
+CORPUS_RECHECK_SECONDS = float(os.getenv("CORPUS_RECHECK_SECONDS") or 5.0)
+
+
+class CorpusStore:
+    """Process-level snapshot of documents.txt, its BM25 index and the FAISS index.
+
+    Requests only read the current snapshot; a daemon thread stats the docs,
+    index and manifest files every few seconds and rebuilds the snapshot when
+    any mtime or size changes. Docs, BM25 and vectors are swapped together,
+    so both retrievers always serve the same corpus.
+    """
+
+    def __init__(self, path: Path, index_path: Path = INDEX_FILE,
+                 manifest_path: Path = MANIFEST_FILE,
+                 recheck_seconds: float = CORPUS_RECHECK_SECONDS,
+                 autoload: bool = True, vectors: bool = True):
+        self.path = path
+        self.index_path = index_path
+        self.manifest_path = manifest_path
+        self.recheck_seconds = recheck_seconds
+        self.vectors = vectors
+        self._signature = None
+        self._docs: list[str] = []
+        self._index = BM25Index([])
+        self._vector = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if autoload:
+            self.refresh()
+
+    def _stat_signature(self):
+        sig = []
+        for path in (self.path, self.index_path, self.manifest_path):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                sig.append(None)
+                continue
+            sig.append((st.st_mtime_ns, st.st_size))
+        return tuple(sig)
+
+    def refresh(self) -> bool:
+        """Reload if any file changed since the last load. Returns True on reload."""
+        sig = self._stat_signature()
+        if sig == self._signature:
+            return False
+        with self._lock:
+            docs = load_docs() if sig[0] is not None else []
+            vector = None
+            if self.vectors:
+                # Reuse the resident embedding model; only the index is re-read.
+                model = self._vector.model if self._vector is not None else None
+                vector = VectorRetriever.load(docs, model)
+                if vector is None and self._vector is not None and self.index_path.exists():
+                    # Mid-rebuild (index and docs not in step yet): keep serving
+                    # the old snapshot and retry on the next check.
+                    print("Corpus reload deferred: vector index does not match documents yet")
+                    return False
+            index = BM25Index(docs)
+            # Swap everything at once so readers never see a mixed snapshot.
+            self._docs, self._index, self._vector, self._signature = docs, index, vector, sig
+        print(
+            f"Corpus loaded: {len(docs)} documents from {self.path} "
+            f"(vector index {'on' if vector is not None else 'off'})"
+        )
+        return True
+
+    @property
+    def docs(self) -> list[str]:
+        return self._docs
+
+    @property
+    def keyword_index(self) -> BM25Index:
+        return self._index
+
+    @property
+    def vector(self):
+        """VectorRetriever for the current snapshot, or None (BM25 only)."""
+        return self._vector
+
+    def _watch(self):
+        while not self._stop.wait(self.recheck_seconds):
+            try:
+                self.refresh()
+            except Exception as e:
+                print("Corpus reload error:", e)
+
+    def start_watcher(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._watch, name="corpus-watcher", daemon=True
+            )
+            self._thread.start()
+
+    def stop_watcher(self):
+        self._stop.set()
+
+
+corpus = CorpusStore(DOCS_FILE, autoload=False)  # loaded by warm_up()
+
+
+@metrics.timed("retrieve_context")
+def retrieve_context(query) -> list[str]:
+    """Top corpus chunks for the query, best first (packed later by pack_context)."""
+    vector = corpus.vector
+    if vector is not None:
+        try:
+            with metrics.span("vector_search"):
+                top = vector.search(query, RAG_TOP_K)
+            if top:
+                return top
+        except Exception as e:
+            print("Vector RAG Error:", e)
+    try:
+        index = corpus.keyword_index
+        if not index.docs:
+            return []
+        top = index.search(query, RAG_TOP_K)
         if not top:
-            top = docs[:3]
-        return "\n\n".join(top)
+            top = index.docs[:RAG_TOP_K]
+        return list(top)
     except Exception as e:
+        metrics.inc("bloom_stage_errors_total", stage="keyword_search")
         print("RAG Error:", e)
-        return ""
+        return []
+
+
+# ----------------- WEB SEARCH -----------------
+WEB_SEARCH_TIMEOUT = float(os.getenv("WEB_SEARCH_TIMEOUT") or 4)
+WEB_SEARCH_TTL = float(os.getenv("WEB_SEARCH_TTL") or 15 * 60)
+WEB_SEARCH_NEGATIVE_TTL = float(os.getenv("WEB_SEARCH_NEGATIVE_TTL") or 2 * 60)
+WEB_SEARCH_MAX_ENTRIES = 512
+
+
+def ddg_search_backend(query: str, max_results: int) -> list[dict]:
+    """Default backend: DuckDuckGo text search. Returns [{"title", "body"}, ...]."""
+    from duckduckgo_search import DDGS
 
+    with DDGS(timeout=WEB_SEARCH_TIMEOUT) as ddgs:
+        return list(ddgs.text(query, max_results=max_results))
 
+
+class WebSearcher:
+    """Web lookups with a TTL cache, negative caching and a hard deadline.
+
+    search() returns the result snippets best first, or None. backend(query,
+    max_results) -> list of {"title", "body"} dicts; swap it
+    (e.g. web_searcher.backend = stub) to run without network access. Empty
+    or failed lookups are cached for negative_ttl so a flaky query is not
+    retried on every message.
+    """
+
+    def __init__(self, backend=ddg_search_backend, ttl=WEB_SEARCH_TTL,
+                 negative_ttl=WEB_SEARCH_NEGATIVE_TTL, timeout=WEB_SEARCH_TIMEOUT,
+                 max_entries=WEB_SEARCH_MAX_ENTRIES):
+        self.backend = backend
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self._cache: OrderedDict = OrderedDict()  # key -> (expires, snippets or None)
+        self._lock = threading.Lock()
+        # Own pool so a hung backend cannot starve the pipeline pool.
+        self._pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="web-search")
+
+    def _store(self, key, value, ttl):
+        with self._lock:
+            self._cache[key] = (time.monotonic() + ttl, value)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def search(self, query: str):
+        key = normalize_message(query)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._cache.move_to_end(key)
+                metrics.inc("bloom_web_search_total", outcome="cached")
+                return entry[1]
+
+        future = self._pool.submit(self.backend, query, 5)
+        try:
+            results = future.result(timeout=self.timeout)
+        except FuturesTimeout:
+            future.cancel()
+            print(f"Web search timed out after {self.timeout}s")
+            metrics.inc("bloom_web_search_total", outcome="timeout")
+            self._store(key, None, self.negative_ttl)
+            return None
+        except Exception as e:
+            print("Web search error:", e)
+            metrics.inc("bloom_web_search_total", outcome="error")
+            self._store(key, None, self.negative_ttl)
+            return None
+
+        if not results:
+            metrics.inc("bloom_web_search_total", outcome="empty")
+            self._store(key, None, self.negative_ttl)
+            return None
+        metrics.inc("bloom_web_search_total", outcome="ok")
+        snippets = [f"- {r['title']}: {r['body']}".strip() for r in results]
+        self._store(key, snippets, self.ttl)
+        return snippets
+
+
+web_searcher = WebSearcher()
+
+
+@metrics.timed("web_search")
 def web_search(query):
-    try:
-        with DDGS() as ddgs:
-            results = list(ddgs.text(query, max_results=5))
-            if not results:
-                return None
-            combined = ""
-            for r in results[:3]:
-                combined += f"- {r['title']}: {r['body']}\n"
-            return combined.strip()
-    except Exception as e:
-        print("Web search error:", e)
-        return None
+    return web_searcher.search(query)
+
+
+# ----------------- INTENT CLASSIFIER -----------------
+INTENT_FILE = DATA_DIR / "intent_examples.json"
+INTENT_MODES = ("medical", "therapy", "technical", "general")
+INTENT_MIN_SCORE = float(os.getenv("INTENT_MIN_SCORE") or 0.2)
+INTENT_MIN_MARGIN = float(os.getenv("INTENT_MIN_MARGIN") or 0.05)
+# The bag-of-words fallback is noisier than embeddings, so it gets its own bar.
+INTENT_BOW_MIN_SCORE = float(os.getenv("INTENT_BOW_MIN_SCORE") or 0.15)
+INTENT_BOW_MIN_MARGIN = float(os.getenv("INTENT_BOW_MIN_MARGIN") or 0.1)
+INTENT_LLM_FALLBACK = (os.getenv("INTENT_LLM_FALLBACK") or "1") != "0"
+INTENT_LLM_TIMEOUT = float(os.getenv("INTENT_LLM_TIMEOUT") or 15)
+
+
+# Function words carry no intent; left in, "what is ..." questions lean medical.
+_INTENT_STOP_WORDS = frozenset(
+    """a an the is are am was were be been being do does did what which who whom
+    how why when where of to in on at for with by from about as and or but if so
+    than that this these those it its there can could would should will shall may
+    might must have has had me you your yours he she they them their we us our
+    i my myself im just very any some all also not no up out into over""".split()
+)
 
 
+def _unit(vec: dict[str, float]) -> dict[str, float]:
+    norm = math.sqrt(sum(v * v for v in vec.values()))
+    return {k: v / norm for k, v in vec.items()} if norm else {}
+
+
+def _sparse_dot(a: dict[str, float], b: dict[str, float]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(k, 0.0) for k, v in a.items())
+
+
+class IntentClassifier:
+    """Nearest-centroid intent classifier trained from data/intent_examples.json.
+
+    Uses the resident sentence-transformers model when vector retrieval is
+    loaded, otherwise TF-IDF bag-of-words vectors over content words only.
+    predict() returns the best mode and its confidence (cosine score and
+    margin over the runner-up); min_score/min_margin are the backend's bar.
+    """
+
+    def __init__(self, examples: dict[str, list[str]], model=None):
+        self.model = model
+        self.labels = [m for m in INTENT_MODES if examples.get(m)]
+        if model is not None:
+            self.min_score, self.min_margin = INTENT_MIN_SCORE, INTENT_MIN_MARGIN
+            self.centroids = self._embed_centroids(examples)
+        else:
+            self.min_score, self.min_margin = INTENT_BOW_MIN_SCORE, INTENT_BOW_MIN_MARGIN
+            all_texts = [t for m in self.labels for t in examples[m]]
+            df: dict[str, int] = {}
+            for text in all_texts:
+                for tok in set(self._content_tokens(text)):
+                    df[tok] = df.get(tok, 0) + 1
+            n = len(all_texts)
+            self.idf = {tok: math.log((1 + n) / (1 + c)) + 1 for tok, c in df.items()}
+            self.centroids = self._bow_centroids(examples)
+
+    @classmethod
+    def load(cls, model=None):
+        try:
+            examples = json.loads(INTENT_FILE.read_text(encoding="utf-8"))
+        except Exception as e:
+            print("Intent classifier disabled:", e)
+            return None
+        return cls(examples, model)
+
+    # ---- bag-of-words backend ----
+    @staticmethod
+    def _content_tokens(text: str) -> list[str]:
+        return [tok for tok in tokenize(text) if tok not in _INTENT_STOP_WORDS]
+
+    def _bow(self, text: str) -> dict[str, float]:
+        """Content-word TF-IDF vector; empty (score 0) when no known word overlaps."""
+        tf: dict[str, float] = {}
+        for tok in self._content_tokens(text):
+            if tok in self.idf:
+                tf[tok] = tf.get(tok, 0.0) + self.idf[tok]
+        return _unit(tf)
+
+    def _bow_centroids(self, examples):
+        centroids = {}
+        for label in self.labels:
+            acc: dict[str, float] = {}
+            for text in examples[label]:
+                for k, v in self._bow(text).items():
+                    acc[k] = acc.get(k, 0.0) + v
+            centroids[label] = _unit(acc)
+        return centroids
+
+    # ---- embedding backend ----
+    def _embed_centroids(self, examples):
+        import numpy as np
+
+        centroids = {}
+        for label in self.labels:
+            vecs = self.model.encode(
+                examples[label], convert_to_numpy=True, normalize_embeddings=True
+            )
+            c = vecs.mean(axis=0)
+            centroids[label] = c / (np.linalg.norm(c) or 1.0)
+        return centroids
+
+    def scores(self, text: str) -> dict[str, float]:
+        if self.model is not None:
+            q = self.model.encode([text], convert_to_numpy=True, normalize_embeddings=True)[0]
+            return {label: float(q @ c) for label, c in self.centroids.items()}
+        q = self._bow(text)
+        return {label: _sparse_dot(q, c) for label, c in self.centroids.items()}
+
+    def predict(self, text: str) -> tuple[str, float, float]:
+        """Return (mode, score, margin) for the best-matching mode."""
+        ranked = sorted(self.scores(text).items(), key=lambda x: x[1], reverse=True)
+        if not ranked:
+            return "general", 0.0, 0.0
+        best, score = ranked[0]
+        runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+        return best, score, score - runner_up
+
+
+intent_classifier = None  # loaded by warm_up()
+
+
+@metrics.timed("detect_mode_local")
+def detect_mode_local(user_msg):
+    """Return the locally classified mode, or None if the LLM should decide."""
+    if intent_classifier is None:
+        return None if INTENT_LLM_FALLBACK else "general"
+    mode, score, margin = intent_classifier.predict(user_msg)
+    min_score = intent_classifier.min_score
+    if score >= min_score and margin >= intent_classifier.min_margin:
+        return mode
+    if not INTENT_LLM_FALLBACK:
+        return mode if score >= min_score else "general"
+    return None
+
+
+def detect_mode(user_msg):
+    """Classify locally; only ask the LLM when the local classifier is unsure."""
+    return detect_mode_local(user_msg) or detect_mode_llm(user_msg)
+
+
+@metrics.timed("detect_mode_llm")
 def detect_mode_llm(user_msg):
     classify_prompt = f"""
 You are a classifier. Classify the user's message into ONLY ONE of these modes:
@@ -445,7 +1599,11 @@ general
 User message: {user_msg}
 Return ONLY the mode word.
 """
-    result = generate_with_ollama(classify_prompt)
+    result = generate_with_ollama(
+        classify_prompt,
+        timeout=(OLLAMA_CONNECT_TIMEOUT, INTENT_LLM_TIMEOUT),
+        stage="ollama_classify",
+    )
     if not result:
         return "general"
     mode = result.strip().lower()
@@ -501,38 +1659,255 @@ def get_or_create_active_conversation(user_id: int) -> int:
     return conv_id
 
 
-def list_messages(conversation_id: int, limit: int = 200):
+def list_messages(
+    conversation_id: int,
+    limit: int = 50,
+    before_id: int | None = None,
+    after_id: int | None = None,
+):
+    """
+    Keyset page over (conversation_id, id), returned oldest-first.
+    - after_id: messages newer than after_id (incremental refresh)
+    - before_id: messages older than before_id (scroll-back)
+    - neither: the most recent `limit` messages
+    Callers flush the reader's queued messages first (flush_user).
+    """
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT id, role, content, created_at
-        FROM messages
-        WHERE conversation_id=?
-        ORDER BY id ASC
-        LIMIT ?
-        """,
-        (conversation_id, limit),
-    )
-    rows = cur.fetchall()
+    if after_id is not None:
+        cur.execute(
+            """
+            SELECT id, role, content, created_at
+            FROM messages
+            WHERE conversation_id=? AND id>?
+            ORDER BY id ASC
+            LIMIT ?
+            """,
+            (conversation_id, after_id, limit),
+        )
+        rows = cur.fetchall()
+    elif before_id is not None:
+        cur.execute(
+            """
+            SELECT id, role, content, created_at
+            FROM messages
+            WHERE conversation_id=? AND id<?
+            ORDER BY id DESC
+            LIMIT ?
+            """,
+            (conversation_id, before_id, limit),
+        )
+        rows = cur.fetchall()[::-1]
+    else:
+        cur.execute(
+            """
+            SELECT id, role, content, created_at
+            FROM messages
+            WHERE conversation_id=?
+            ORDER BY id DESC
+            LIMIT ?
+            """,
+            (conversation_id, limit),
+        )
+        rows = cur.fetchall()[::-1]
     conn.close()
     return [dict(r) for r in rows]
 
 
-def insert_message(conversation_id: int, user_id: int, role: str, content: str):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO messages (conversation_id, user_id, role, content, created_at) "
-        "VALUES (?, ?, ?, ?, datetime('now'))",
-        (conversation_id, user_id, role, content),
-    )
-    cur.execute(
-        "UPDATE conversations SET updated_at=datetime('now') WHERE id=?",
-        (conversation_id,),
-    )
-    conn.commit()
-    conn.close()
+# ----------------- MESSAGE WRITER (group commit) -----------------
+DB_WRITE_BATCH_MS = float(os.getenv("DB_WRITE_BATCH_MS") or 5)
+DB_WRITE_MAX_BATCH = int(os.getenv("DB_WRITE_MAX_BATCH") or 256)
+# Longest a request waits on the writer (crisis replies, history reads).
+DB_WRITE_WAIT_SECONDS = float(os.getenv("DB_WRITE_WAIT_SECONDS") or 5)
+
+
+def _utc_now() -> str:
+    """Same format SQLite's datetime('now') produces."""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+
+class MessageWriter:
+    """Background writer that commits queued messages in batches.
+
+    Rows submitted within DB_WRITE_BATCH_MS of each other share a single
+    transaction (one INSERT batch plus one counter/timestamp update per
+    conversation),
+    so fsyncs scale with batches, not with messages. submit(wait=True)
+    blocks until the row is committed; flush_user() waits only for the rows
+    one user queued, flush() for everything queued.
+    """
+
+    _STOP = object()
+
+    def __init__(self, batch_ms: float = DB_WRITE_BATCH_MS, max_batch: int = DB_WRITE_MAX_BATCH):
+        self.batch_s = batch_ms / 1000
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._cond = threading.Condition()
+        self._submitted = 0
+        self._done = 0
+        self._last_seq: dict[int, int] = {}  # user_id -> newest uncommitted seq
+        self.batches = 0
+        self.commit_seconds = 0.0
+        self.max_commit_seconds = 0.0
+        self.max_batch_rows = 0
+        self.lock_errors = 0
+        self._thread = None  # started on first use, so importing starts nothing
+
+    def start(self):
+        """Start the writer thread if it is not running (e.g. after a fork)."""
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="message-writer", daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, conversation_id, user_id, role, content, wait=False):
+        self.start()
+        with self._cond:
+            self._submitted += 1
+            seq = self._submitted
+            self._last_seq[user_id] = seq
+            # Enqueue under the lock so queue order matches sequence order.
+            self._queue.put((conversation_id, user_id, role, content, _utc_now()))
+        if wait and not self.wait_for(seq, DB_WRITE_WAIT_SECONDS):
+            print("Message writer: commit still pending after", DB_WRITE_WAIT_SECONDS, "s")
+        return seq
+
+    def wait_for(self, seq, timeout=None) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self._done >= seq, timeout)
+
+    def flush(self, timeout=None) -> bool:
+        with self._cond:
+            target = self._submitted
+        return self.wait_for(target, timeout)
+
+    def flush_user(self, user_id, timeout=None) -> bool:
+        """Wait until this user's own queued messages are committed."""
+        with self._cond:
+            target = self._last_seq.get(user_id, 0)
+        return self.wait_for(target, timeout)
+
+    def close(self, timeout=10):
+        """Drain the queue and stop the writer thread (called at exit)."""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.batch_s
+            stop = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        item = self._queue.get(timeout=remaining)
+                    else:
+                        item = self._queue.get_nowait()  # window over: take only what's ready
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._write(batch)
+            except Exception as e:  # never let one bad batch stop the writer
+                print("Message writer dropped", len(batch), "rows:", e)
+            with self._cond:
+                self._done += len(batch)
+                self._last_seq = {
+                    u: seq for u, seq in self._last_seq.items() if seq > self._done
+                }
+                self._cond.notify_all()
+            if stop:
+                return
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "rows": self._done,
+                "pending": self._submitted - self._done,
+                "batches": self.batches,
+                "max_batch_rows": self.max_batch_rows,
+                "commit_seconds_total": round(self.commit_seconds, 4),
+                "commit_seconds_max": round(self.max_commit_seconds, 4),
+                "lock_errors": self.lock_errors,
+            }
+
+    def _write(self, batch):
+        delay = 0.05
+        while True:
+            try:
+                conn = get_db_connection()
+                break
+            except sqlite3.Error as e:  # pool exhausted: keep the batch and retry
+                print("Message writer waiting for a database connection:", e)
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+        started = time.perf_counter()
+        try:
+            self._write_rows(conn, batch)
+            conn.commit()
+        except sqlite3.Error as e:
+            if "locked" in str(e):
+                self.lock_errors += 1
+            conn.rollback()
+            print("Message batch write failed, retrying row by row:", e)
+            for row in batch:
+                try:
+                    self._write_rows(conn, [row])
+                    conn.commit()
+                except sqlite3.Error as e2:
+                    conn.rollback()
+                    print("Dropped message for conversation", row[0], ":", e2)
+        finally:
+            conn.close()
+        elapsed = time.perf_counter() - started
+        metrics.observe("bloom_stage_seconds", elapsed, stage="db_write")
+        self.batches += 1
+        self.commit_seconds += elapsed
+        self.max_commit_seconds = max(self.max_commit_seconds, elapsed)
+        self.max_batch_rows = max(self.max_batch_rows, len(batch))
+
+    @staticmethod
+    def _write_rows(conn, rows):
+        conn.executemany(
+            "INSERT INTO messages (conversation_id, user_id, role, content, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        latest: dict[int, str] = {}
+        counts: dict[int, int] = {}
+        for conv_id, _, _, _, created_at in rows:
+            latest[conv_id] = max(created_at, latest.get(conv_id, ""))
+            counts[conv_id] = counts.get(conv_id, 0) + 1
+        conn.executemany(
+            "UPDATE conversations SET updated_at=?, last_message_at=?, "
+            "message_count=message_count+? WHERE id=?",
+            [(ts, ts, counts[conv_id], conv_id) for conv_id, ts in latest.items()],
+        )
+
+
+message_writer = MessageWriter()
+atexit.register(message_writer.close)
+
+
+def insert_message(
+    conversation_id: int, user_id: int, role: str, content: str, sync: bool = False
+):
+    """Queue a message for the background writer; sync=True waits for the commit.
+
+    Returns the writer sequence number of the queued row.
+    """
+    return message_writer.submit(conversation_id, user_id, role, content, wait=sync)
 
 
 # ----------------- AUTH ROUTES -----------------
@@ -549,8 +1924,8 @@ def register():
         return jsonify({"error": "Username and password are required"}), 400
 
     password_hash = generate_password_hash(password)
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
         cur = conn.cursor()
         cur.execute(
             "INSERT INTO users (username, password_hash, created_at) "
@@ -559,9 +1934,10 @@ def register():
         )
         conn.commit()
         user_id = cur.lastrowid
-        conn.close()
     except sqlite3.IntegrityError:
         return jsonify({"error": "Username already taken"}), 409
+    finally:
+        conn.close()
 
     # auto-login + new conversation
     session["user_id"] = user_id
@@ -619,13 +1995,33 @@ def logout():
 
 
 # ----------------- HISTORY & CONVERSATIONS -----------------
+HISTORY_PAGE_SIZE = 50
+
+
 @app.route("/history", methods=["GET"])
 @login_required
 def history():
+    """
+    Query params (all optional):
+      limit      page size (default 50, max 200)
+      before_id  older messages than this id, for scroll-back
+      after_id   newer messages than this id, for incremental refresh
+    has_more tells whether another page exists in the requested direction.
+    """
     user_id = session["user_id"]
     conv_id = get_or_create_active_conversation(user_id)
-    msgs = list_messages(conv_id, limit=500)
-    return jsonify({"conversation_id": conv_id, "messages": msgs})
+    limit = min(max(request.args.get("limit", HISTORY_PAGE_SIZE, type=int), 1), 200)
+    before_id = request.args.get("before_id", type=int)
+    after_id = request.args.get("after_id", type=int)
+    message_writer.flush_user(user_id, DB_WRITE_WAIT_SECONDS)
+    msgs = list_messages(conv_id, limit + 1, before_id=before_id, after_id=after_id)
+    has_more = len(msgs) > limit
+    if has_more:
+        # The extra row only signals another page; drop it from the far end.
+        msgs = msgs[:limit] if after_id is not None else msgs[1:]
+    return jsonify(
+        {"conversation_id": conv_id, "messages": msgs, "has_more": has_more}
+    )
 
 
 @app.route("/conversations", methods=["GET", "POST"])
@@ -639,15 +2035,15 @@ def conversations():
         session["conv_id"] = conv_id
         return jsonify({"conversation_id": conv_id, "title": title})
 
+    message_writer.flush_user(user_id, DB_WRITE_WAIT_SECONDS)
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute(
         """
-        SELECT c.id, c.title, c.created_at, c.updated_at,
-               (SELECT COUNT(1) FROM messages m WHERE m.conversation_id=c.id) as message_count
-        FROM conversations c
-        WHERE c.user_id=?
-        ORDER BY c.updated_at DESC
+        SELECT id, title, created_at, updated_at, message_count, last_message_at
+        FROM conversations
+        WHERE user_id=?
+        ORDER BY updated_at DESC
         """,
         (user_id,),
     )
@@ -680,58 +2076,491 @@ def switch_conversation():
     return jsonify({"message": "Switched", "conversation_id": conv_id})
 
 
+# ----------------- RESPONSE CACHE -----------------
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL") or 6 * 3600)
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES") or 8 * 1024 * 1024)
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY") or 0.95)
+
+
+def normalize_message(text: str) -> str:
+    return " ".join(tokenize(text))
+
+
+class ResponseCache:
+    """LRU + TTL cache of raw LLM generations keyed on (message, context).
+
+    Exact hits match the normalized message and the context hash. With an
+    embedding model, a miss falls back to the most similar cached message
+    with the same context (cosine >= RESPONSE_CACHE_SIMILARITY), found with
+    one matmul over that context's vectors outside the lock. Entries are
+    evicted oldest-first once the byte budget is exceeded.
+    """
+
+    def __init__(self, ttl=RESPONSE_CACHE_TTL, max_bytes=RESPONSE_CACHE_MAX_BYTES,
+                 model=None, similarity=RESPONSE_CACHE_SIMILARITY):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.model = model
+        self.similarity = similarity
+        self._entries: OrderedDict = OrderedDict()  # key -> (expires, value, vec, size)
+        self._bytes = 0
+        # context hash -> (keys, matrix of their vectors); rebuilt on change
+        # and only swapped under the lock, so readers can use it unlocked.
+        self._vectors: dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(user_msg: str, context: str):
+        ctx = hashlib.sha1(context.encode("utf-8")).hexdigest()
+        return (normalize_message(user_msg), ctx)
+
+    def _embed(self, text: str):
+        if self.model is None:
+            return None
+        try:
+            return self.model.encode([text], convert_to_numpy=True, normalize_embeddings=True)[0]
+        except Exception as e:
+            print("Response cache embedding error:", e)
+            return None
+
+    def _drop(self, key):
+        _, _, vec, size = self._entries.pop(key)
+        self._bytes -= size
+        if vec is not None:
+            import numpy as np
+
+            keys, matrix = self._vectors.pop(key[1])
+            i = keys.index(key)
+            if len(keys) > 1:
+                self._vectors[key[1]] = (keys[:i] + keys[i + 1:], np.delete(matrix, i, axis=0))
+
+    def _index(self, key, vec):
+        """Add a vector to its context's matrix (lock held); copies, never mutates."""
+        import numpy as np
+
+        keys, matrix = self._vectors.get(key[1], ([], None))
+        rows = vec[None, :] if matrix is None else np.vstack([matrix, vec])
+        self._vectors[key[1]] = (keys + [key], rows)
+
+    def get(self, user_msg: str, context: str):
+        key = self._key(user_msg, context)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                self._drop(key)
+            group = self._vectors.get(key[1])
+        vec = self._embed(key[0]) if group is not None else None
+        candidates = []
+        if vec is not None:
+            keys, matrix = group
+            sims = matrix @ vec
+            candidates = [keys[i] for i in sims.argsort()[::-1] if sims[i] >= self.similarity]
+        with self._lock:
+            for k in candidates:
+                entry = self._entries.get(k)  # may have been evicted meanwhile
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(k)
+                    self.near_hits += 1
+                    return entry[1]
+            self.misses += 1
+        return None
+
+    def put(self, user_msg: str, context: str, value: str):
+        key = self._key(user_msg, context)
+        vec = self._embed(key[0]) if self.model is not None else None
+        size = len(key[0]) + len(key[1]) + len(value) + (vec.nbytes if vec is not None else 0)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, vec, size)
+            self._bytes += size
+            if vec is not None:
+                self._index(key, vec)
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+response_cache = ResponseCache()  # warm_up() attaches the embedding model
+
+
+# ----------------- CONTEXT PACKING -----------------
+# Prompt tokens allowed = num_ctx minus the reply (num_predict) minus a safety margin.
+CONTEXT_TOKEN_MARGIN = int(os.getenv("CONTEXT_TOKEN_MARGIN") or 16)
+PROMPT_TOKEN_BUDGET = OLLAMA_NUM_CTX - OLLAMA_NUM_PREDICT - CONTEXT_TOKEN_MARGIN
+TOKENIZER_PATH = os.getenv("TOKENIZER_PATH")  # optional tokenizer.json for the chat model
+MIN_CHUNK_TOKENS = 24  # don't bother trimming a chunk below this
+
+# Estimator pieces: words, single punctuation marks and newlines.
+_TOKEN_PIECE_RE = re.compile(r"\w+|[^\w\s]|\n")
+
+
+class TokenCounter:
+    """Counts and truncates text in model tokens.
+
+    Uses the HF `tokenizers` library (installed with sentence-transformers)
+    when TOKENIZER_PATH points at the chat model's tokenizer.json; otherwise a
+    fast estimate that errs high: one token per punctuation mark or newline,
+    and one per started 6 characters of a word.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.tokenizer = None
+        if path:
+            try:
+                from tokenizers import Tokenizer
+
+                self.tokenizer = Tokenizer.from_file(path)
+            except Exception as e:
+                print("Tokenizer unavailable, estimating token counts:", e)
+
+    def token_ends(self, text: str) -> list[int]:
+        """Character offset where each token ends."""
+        if self.tokenizer is not None:
+            return [end for _, end in self.tokenizer.encode(text, add_special_tokens=False).offsets]
+        ends = []
+        for m in _TOKEN_PIECE_RE.finditer(text):
+            start, end = m.span()
+            for cut in range(start + 6, end, 6):
+                ends.append(cut)
+            ends.append(end)
+        return ends
+
+    def count(self, text: str) -> int:
+        return len(self.token_ends(text))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Keep at most max_tokens, cutting back to a sentence or word boundary."""
+        ends = self.token_ends(text)
+        if len(ends) <= max_tokens:
+            return text
+        if max_tokens <= 0:
+            return ""
+        head = text[: ends[max_tokens - 1]]
+        cut = max(head.rfind(". "), head.rfind("\n"))
+        if cut < len(head) // 2:
+            cut = head.rfind(" ")
+        if cut > 0:
+            head = head[: cut + 1]
+        return head.rstrip() + " …"
+
+
+token_counter = TokenCounter(TOKENIZER_PATH)
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Token count, memoized: corpus chunks and snippets repeat across requests."""
+    return token_counter.count(text)
+
+
+def pack_context(user_msg: str, chunks: list[str] | None, history: str = "") -> str:
+    """Fit ranked chunks (best first) into what the prompt budget leaves over.
+
+    The room is what the assembled prompt without context (instructions,
+    memory `history`, message) leaves of PROMPT_TOKEN_BUDGET. Whole chunks
+    are taken in rank order while they fit; the first one that doesn't is
+    trimmed to the remaining space (if that is worth it) and packing stops
+    there. The finished prompt is counted again and trimmed until it fits.
+    """
+    available = PROMPT_TOKEN_BUDGET - token_counter.count(build_prompt(user_msg, "", history))
+    picked = []
+    for i, chunk in enumerate(chunks or []):
+        chunk = chunk.strip()
+        if not chunk:
+            continue
+        cost = count_tokens(chunk) + 1  # + separator
+        if cost <= available:
+            picked.append(chunk)
+            available -= cost
+            metrics.inc("bloom_context_chunks_total", result="kept")
+            continue
+        if available >= MIN_CHUNK_TOKENS:
+            picked.append(token_counter.truncate(chunk, available - 2))
+            metrics.inc("bloom_context_chunks_total", result="trimmed")
+            i += 1
+        metrics.inc("bloom_context_chunks_total", len(chunks) - i, result="dropped")
+        break
+    # Per-part counts don't add up exactly to the assembled prompt's (token
+    # boundaries at the joins), so settle the overshoot on the last chunk
+    # instead of letting it eat CONTEXT_TOKEN_MARGIN.
+    while picked:
+        prompt = build_prompt(user_msg, "\n\n".join(picked), history)
+        over = token_counter.count(prompt) - PROMPT_TOKEN_BUDGET
+        if over <= 0:
+            break
+        last = picked.pop()
+        keep = count_tokens(last) - over - 2  # room for the " …" marker
+        if keep >= MIN_CHUNK_TOKENS:
+            picked.append(token_counter.truncate(last, keep))
+    return "\n\n".join(picked)
+
+
+def _prompt_room() -> int:
+    """Budget left after the fixed prompt instructions."""
+    empty = PROMPT_TEMPLATE.format(context="", history="", user_msg="")
+    return PROMPT_TOKEN_BUDGET - count_tokens(empty)
+
+
+def clip_user_message(user_msg: str) -> str:
+    """Cut very long messages so the prompt itself never overflows the window.
+
+    The memory share (memory_budget) is reserved first; the message gets the rest.
+    """
+    room = _prompt_room() - memory_budget()
+    return token_counter.truncate(user_msg, max(MIN_CHUNK_TOKENS, room))
+
+
+# ----------------- CONVERSATION MEMORY -----------------
+MEMORY_RECENT_TURNS = int(os.getenv("MEMORY_RECENT_TURNS") or 3)
+# 0 = derive from the window: memory gets half the room the instructions
+# leave, the summary a third of that, so the summary plus one turn always fit.
+MEMORY_PROMPT_TOKENS = int(os.getenv("MEMORY_PROMPT_TOKENS") or 0)
+MEMORY_SUMMARY_TOKENS = int(os.getenv("MEMORY_SUMMARY_TOKENS") or 0)
+MEMORY_HEADER = "Conversation so far:\n"
+MEMORY_TURN_TOKENS = 48  # stored per user message in the recent window
+MEMORY_REPLY_TOKENS = 24  # stored per bot reply (its opening sentence)
+MEMORY_NOTE_TOKENS = 20  # per turn folded into the summary
+
+# One worker: updates are applied in order and never race on the same row.
+memory_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory")
+
+
+def _opening(text: str, max_tokens: int) -> str:
+    """First sentence of text, capped at max_tokens."""
+    text = " ".join(text.split())
+    m = re.search(r"[.!?](\s|$)", text)
+    if m:
+        text = text[: m.end()].strip()
+    return token_counter.truncate(text, max_tokens)
+
+
+def load_memory(conv_id: int) -> tuple[str, list]:
+    """(summary, recent turns) stored on the conversation row."""
+    conn = get_db_connection()
+    try:
+        row = conn.execute(
+            "SELECT summary, recent_turns FROM conversations WHERE id=?", (conv_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return "", []
+    try:
+        turns = json.loads(row["recent_turns"] or "[]")
+    except ValueError:
+        turns = []
+    return row["summary"] or "", turns
+
+
+def memory_budget() -> int:
+    """Tokens every prompt reserves for the memory block, before the context.
+
+    Fixed per window, so stored memory can be sized to fit it as-is. Always
+    leaves the user message MIN_CHUNK_TOKENS.
+    """
+    room = _prompt_room()
+    budget = MEMORY_PROMPT_TOKENS or room // 2
+    return max(0, min(budget, room - MIN_CHUNK_TOKENS))
+
+
+def _summary_cap() -> int:
+    return MEMORY_SUMMARY_TOKENS or memory_budget() // 3
+
+
+def memory_block(notes: list[str], turns: list) -> str:
+    """The memory as it goes into the prompt: summary notes, then turns, oldest first."""
+    lines = list(notes)
+    for user, bot in turns:
+        lines.append(f"User: {user}\nBot: {bot}" if bot else f"User: {user}")
+    if not lines:
+        return ""
+    return MEMORY_HEADER + "\n".join(lines) + "\n\n"
+
+
+def fold_turn(summary: str, turns: list, user_msg: str, bot_reply: str) -> tuple[str, list]:
+    """Append a turn, folding older turns into the summary when needed."""
+    turns = turns + [[
+        token_counter.truncate(" ".join(user_msg.split()), MEMORY_TURN_TOKENS),
+        _opening(bot_reply, MEMORY_REPLY_TOKENS),
+    ]]
+    return fit_memory(summary, turns)
+
+
+def fit_memory(summary: str, turns: list) -> tuple[str, list]:
+    """Fold turns into summary notes until the memory fits memory_budget().
+
+    Nothing changes while the turns fit the window (MEMORY_RECENT_TURNS) and
+    the budget, so between folds the memory block only grows at its end and
+    consecutive prompts of a conversation share it as a prefix. A fold
+    turns the oldest turns into one-line notes (the gist of what the user
+    said) until at most half the window is left; the summary drops its
+    oldest notes beyond the summary cap. Only the newest turn is ever
+    shortened, and only if it cannot fit on its own.
+    """
+    budget, cap = memory_budget(), _summary_cap()
+    turns = [list(turn) for turn in turns]
+    notes = [line for line in summary.splitlines() if line.strip()]
+
+    def cost():
+        return token_counter.count(memory_block(notes, turns))
+
+    if len(turns) > MEMORY_RECENT_TURNS or cost() > budget:
+        keep = max(1, MEMORY_RECENT_TURNS // 2)
+        while len(turns) > 1 and (len(turns) > keep or cost() > budget):
+            old_user, _ = turns.pop(0)
+            note = "- " + _opening(old_user, max(1, min(MEMORY_NOTE_TOKENS, cap - 1)))
+            if not notes or notes[-1] != note:
+                notes.append(note)
+            while notes and token_counter.count("\n".join(notes)) > cap:
+                notes.pop(0)
+        if turns and cost() > budget:
+            turns[-1][1] = ""  # keep what the user said over the bot's tips
+        over = cost() - budget
+        if turns and over > 0:
+            user = turns[-1][0]
+            turns[-1][0] = token_counter.truncate(user, count_tokens(user) - over - 2)
+    return "\n".join(notes), turns
+
+
+def update_memory(conv_id: int, user_msg: str, bot_reply: str):
+    try:
+        with metrics.span("memory_update"):
+            summary, turns = load_memory(conv_id)
+            summary, turns = fold_turn(summary, turns, user_msg, bot_reply)
+            conn = get_db_connection()
+            try:
+                conn.execute(
+                    "UPDATE conversations SET summary=?, recent_turns=? WHERE id=?",
+                    (summary, json.dumps(turns, ensure_ascii=False), conv_id),
+                )
+                conn.commit()
+            finally:
+                conn.close()
+    except Exception as e:
+        print("Memory update failed for conversation", conv_id, ":", e)
+
+
+def remember_turn(conv_id: int, user_msg: str, final_reply: str):
+    """Fold the turn into the conversation's memory in the background."""
+    memory_pool.submit(update_memory, conv_id, user_msg, final_reply)
+
+
+def prompt_memory(conv_id: int) -> str:
+    """Memory block for the prompt, rendered as stored (it already fits)."""
+    if memory_budget() <= 0:
+        return ""
+    summary, turns = fit_memory(*load_memory(conv_id))  # no-op unless settings shrank
+    return memory_block(summary.splitlines(), turns)
+
+
 # ----------------- CHAT -----------------
-@app.route("/chat", methods=["POST"])
-@login_required
-def chat():
-    data = request.get_json() or {}
-    user_msg = (data.get("message") or "").strip()
-    user_id = session.get("user_id")
+CRISIS_REPLY = (
+    "I'm really sorry you're feeling this way. If you are in immediate danger, "
+    "please contact local emergency services. Consider calling a suicide prevention "
+    "helpline in your country. You are not alone."
+)
 
-    if not user_msg:
-        return jsonify({"reply": "Please share what you are feeling. 💬"}), 400
 
-    conv_id = get_or_create_active_conversation(user_id)
+def is_crisis(user_msg: str) -> bool:
+    return "crisis" in message_categories(user_msg)
 
-    # Crisis check (not stored until verified)
-    lower = user_msg.lower()
-    crisis_keywords = ["suicide", "kill myself", "end my life", "hurt myself"]
-    if any(k in lower for k in crisis_keywords):
-        reply = (
-            "I'm really sorry you're feeling this way. If you are in immediate danger, "
-            "please contact local emergency services. Consider calling a suicide prevention "
-            "helpline in your country. You are not alone."
-        )
-        # Store both messages to the transcript
-        insert_message(conv_id, user_id, "user", user_msg)
-        insert_message(conv_id, user_id, "bot", reply)
-        return jsonify({"reply": reply, "crisis": True})
 
-    # Store user message
-    insert_message(conv_id, user_id, "user", user_msg)
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS") or 16)
+SPECULATIVE_WEB_SEARCH = (os.getenv("SPECULATIVE_WEB_SEARCH") or "1") != "0"
 
-    # Routing for retrieval
-    mode = detect_mode_llm(user_msg)
-    live_keywords = [
-        "latest",
-        "news",
-        "today",
-        "current",
-        "update",
-        "price",
-        "weather",
-    ]
-    medical_trigger = any(
-        w in lower
-        for w in ["symptoms", "causes", "treatment", "disease", "disorder", "ptsd", "trauma"]
-    )
+# Shared pool for running independent pipeline stages side by side.
+pipeline_pool = ThreadPoolExecutor(
+    max_workers=PIPELINE_WORKERS, thread_name_prefix="pipeline"
+)
 
-    if mode == "medical" or any(w in lower for w in live_keywords) or medical_trigger:
-        context = web_search(user_msg) or ""
-    else:
-        context = retrieve_context(user_msg)
 
-    prompt = f"""You are a supportive, trauma-informed mental-health assistant.
+def lookup_cache(user_msg: str, context: str):
+    with metrics.span("cache_lookup"):
+        return response_cache.get(user_msg, context)
+
+
+def route_locally(user_msg: str) -> str | None:
+    """"web" or "local" when keywords or the local classifier decide, else None."""
+    cats = message_categories(user_msg)
+    if "live" in cats or "medical" in cats:
+        return "web"
+    mode = detect_mode_local(user_msg)
+    if mode is None:
+        return None
+    return "web" if mode == "medical" else "local"
+
+
+@metrics.timed("gather_context")
+def gather_context(user_msg: str, history: str = "") -> tuple[str, str | None]:
+    """Return the packed context block and the cached generation for it, if any.
+
+    Keyword triggers and the local classifier route immediately. Otherwise
+    local retrieval runs first (with web search started speculatively) and
+    the cache is checked with that context; only a miss pays for the LLM
+    classification. A web search that comes back empty or misses its
+    deadline falls back to local retrieval. `history` is the memory block
+    the prompt will carry; the context gets the room it leaves.
+    """
+    route = route_locally(user_msg)
+    if route is not None:
+        chunks = retrieve_context(user_msg) if route == "local" else (
+            web_search(user_msg) or retrieve_context(user_msg)
+        )
+        context = pack_context(user_msg, chunks, history)
+        return context, lookup_cache(user_msg, context)
+
+    # Slow path: local RAG + cache first, LLM classification only on a miss.
+    web_f = (
+        pipeline_pool.submit(web_search, user_msg) if SPECULATIVE_WEB_SEARCH else None
+    )
+    context = pack_context(user_msg, retrieve_context(user_msg), history)
+    cached = lookup_cache(user_msg, context)
+    # cancel() only drops a search that is still queued; one that already
+    # started runs to completion on its pool thread and its result is ignored.
+    if cached is not None:
+        if web_f is not None:
+            web_f.cancel()
+        return context, cached
+    if detect_mode_llm(user_msg) == "medical":
+        web = web_f.result() if web_f else web_search(user_msg)
+        if web:
+            context = pack_context(user_msg, web, history)
+            return context, lookup_cache(user_msg, context)
+        return context, None  # search failed or timed out: keep local RAG
+    if web_f is not None:
+        web_f.cancel()
+    return context, None
+
+
+# The instructions open every prompt unchanged, so Ollama reuses their KV
+# cache between requests; everything that varies comes after. The memory
+# block follows: it only grows at its end between folds (see fit_memory),
+# so consecutive prompts of a conversation also share it, except at the
+# default 512-token window, where memory folds on every turn.
+PROMPT_PREFIX = """You are a supportive, trauma-informed mental-health assistant.
 Use the context only if helpful. Reply as PLAIN TEXT only.
 Do NOT restate or paraphrase the user's question.
 Structure:
@@ -740,7 +2569,8 @@ Structure:
 - 1 gentle sign-off
 Avoid clinical diagnosis/treatment instructions. Not a substitute for professional care.
 
-Context (optional):
+"""
+PROMPT_TEMPLATE = PROMPT_PREFIX + """{history}Context (optional):
 {context}
 
 User:
@@ -748,32 +2578,311 @@ User:
 
 Answer:"""
 
-    gen = generate_with_ollama(prompt)
 
+def build_prompt(user_msg: str, context: str, history: str = "") -> str:
+    return PROMPT_TEMPLATE.format(
+        context=context, history=history, user_msg=clip_user_message(user_msg)
+    )
+
+
+def finalize_reply(user_msg: str, gen, source: str = "llm") -> str:
+    """Clean raw LLM output (or fall back to the playbook) and add the emoji.
+
+    `source` labels where gen came from ("llm" or "cache") in the reply metrics.
+    """
+    reply_text = None
     if isinstance(gen, str) and gen.strip():
         reply_text = clean_llm_output(gen).strip()
         reply_text = remove_question_echo(user_msg, reply_text)
         # Use playbook if the result is low-quality (echo/too short)
         if is_low_quality(user_msg, reply_text):
-            play = therapy_playbook_reply(user_msg)
-            reply_text = play or fallback_generate(user_msg)
-    else:
-        # LLM missing/unreachable → strong offline playbook first
-        play = therapy_playbook_reply(user_msg)
-        reply_text = play or fallback_generate(user_msg)
+            metrics.inc("bloom_low_quality_total")
+            reply_text = None
+    if reply_text is None:
+        # LLM missing/unreachable/low quality → strong offline playbook first
+        reply_text = therapy_playbook_reply(user_msg)
+        if reply_text:
+            source = "playbook"
+        else:
+            reply_text = fallback_generate(user_msg)
+            source = "fallback"
+    metrics.inc("bloom_replies_total", source=source)
 
     emoji = detect_emoji(user_msg)
-    final_reply = f"{reply_text} {emoji}"
+    return f"{reply_text} {emoji}"
+
+
+def cache_generation(user_msg: str, context: str, gen, history: str = ""):
+    """Cache only generations that finalize_reply would actually use.
+
+    The cache is keyed on message + retrieved context, so replies written
+    with a conversation's memory in the prompt are not stored: they may
+    refer to that conversation, and must not be served to anyone else.
+    """
+    if history or not (isinstance(gen, str) and gen.strip()):
+        return
+    cleaned = remove_question_echo(user_msg, clean_llm_output(gen).strip())
+    if not is_low_quality(user_msg, cleaned):
+        response_cache.put(user_msg, context, gen)
+
+
+@app.route("/chat", methods=["POST"])
+@login_required
+def chat():
+    data = request.get_json() or {}
+    user_msg = (data.get("message") or "").strip()
+    user_id = session.get("user_id")
+
+    if not user_msg:
+        return jsonify({"reply": "Please share what you are feeling. 💬"}), 400
+
+    started = time.perf_counter()
+    conv_id = get_or_create_active_conversation(user_id)
+
+    # Crisis check (not stored until verified)
+    if is_crisis(user_msg):
+        # Store both messages to the transcript
+        insert_message(conv_id, user_id, "user", user_msg)
+        insert_message(conv_id, user_id, "bot", CRISIS_REPLY, sync=True)
+        metrics.inc("bloom_replies_total", source="crisis")
+        metrics.observe("bloom_request_seconds", time.perf_counter() - started, endpoint="chat")
+        return jsonify({"reply": CRISIS_REPLY, "crisis": True})
+
+    # Store user message
+    insert_message(conv_id, user_id, "user", user_msg)
+
+    history = prompt_memory(conv_id)
+    context, gen = gather_context(user_msg, history)
+    source = "cache"
+    if gen is None:
+        source = "llm"
+        gen = generate_with_ollama(build_prompt(user_msg, context, history))
+        cache_generation(user_msg, context, gen, history)
+    final_reply = finalize_reply(user_msg, gen, source)
 
     # Store bot reply
     insert_message(conv_id, user_id, "bot", final_reply)
 
-    # Also keep ephemeral memory
-    conversation_memory.append(f"User: {user_msg}")
-    conversation_memory.append(f"Bot: {final_reply}")
+    # Fold into the conversation's rolling memory (background)
+    remember_turn(conv_id, user_msg, final_reply)
 
+    metrics.observe("bloom_request_seconds", time.perf_counter() - started, endpoint="chat")
     return jsonify({"reply": final_reply, "conversation_id": conv_id})
 
 
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route("/chat/stream", methods=["POST"])
+@login_required
+def chat_stream():
+    """
+    Same pipeline as /chat, but streams the reply as Server-Sent Events:
+      event: token  data: {"text": "..."}   (zero or more)
+      event: done   data: {"reply": "...", "conversation_id": N}
+    The "done" reply is the final cleaned text and replaces the streamed draft.
+    """
+    data = request.get_json() or {}
+    user_msg = (data.get("message") or "").strip()
+    user_id = session.get("user_id")
+
+    if not user_msg:
+        return jsonify({"reply": "Please share what you are feeling. 💬"}), 400
+
+    started = time.perf_counter()
+    conv_id = get_or_create_active_conversation(user_id)
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+    def record_latency():
+        metrics.observe(
+            "bloom_request_seconds", time.perf_counter() - started, endpoint="chat_stream"
+        )
+
+    if is_crisis(user_msg):
+        insert_message(conv_id, user_id, "user", user_msg)
+        insert_message(conv_id, user_id, "bot", CRISIS_REPLY, sync=True)
+        metrics.inc("bloom_replies_total", source="crisis")
+        record_latency()
+        body = _sse(
+            "done",
+            {"reply": CRISIS_REPLY, "crisis": True, "conversation_id": conv_id},
+        )
+        return Response(body, mimetype="text/event-stream", headers=headers)
+
+    insert_message(conv_id, user_id, "user", user_msg)
+    history = prompt_memory(conv_id)
+    context, cached = gather_context(user_msg, history)
+    if cached is not None:
+        final_reply = finalize_reply(user_msg, cached, "cache")
+        insert_message(conv_id, user_id, "bot", final_reply)
+        remember_turn(conv_id, user_msg, final_reply)
+        record_latency()
+        body = _sse("done", {"reply": final_reply, "conversation_id": conv_id})
+        return Response(body, mimetype="text/event-stream", headers=headers)
+
+    prompt = build_prompt(user_msg, context, history)
+
+    def events():
+        cleaner = StreamingCleaner()
+        raw = []
+        pieces = stream_with_ollama(prompt)
+        truncated = False
+        try:
+            for piece in pieces:
+                raw.append(piece)
+                text = cleaner.feed(piece)
+                if text:
+                    yield _sse("token", {"text": text})
+                if cleaner.stopped:
+                    break
+        except StreamTruncated:
+            truncated = True  # the draft is replaced by the fallback in "done"
+        finally:
+            pieces.close()  # stop reading once a stop marker is seen
+        tail = cleaner.finish()
+        if tail and not truncated:
+            yield _sse("token", {"text": tail})
+
+        gen = None if truncated else "".join(raw) or None
+        cache_generation(user_msg, context, gen, history)
+        final_reply = finalize_reply(user_msg, gen)
+        insert_message(conv_id, user_id, "bot", final_reply)
+        remember_turn(conv_id, user_msg, final_reply)
+        record_latency()
+        yield _sse("done", {"reply": final_reply, "conversation_id": conv_id})
+
+    return Response(events(), mimetype="text/event-stream", headers=headers)
+
+
+# ----------------- STARTUP / WARM-UP -----------------
+STARTUP_WAIT_SECONDS = float(os.getenv("STARTUP_WAIT_SECONDS") or 60)
+
+_warmed_up = threading.Event()  # warm-up finished, whether or not every step succeeded
+_warm_up_lock = threading.Lock()
+_warm_up_started = threading.Lock()  # held by the first start_warm_up() forever
+startup_timings: dict[str, float] = {}
+startup_errors: dict[str, str] = {}
+
+
+def _timed(name, fn):
+    started = time.perf_counter()
+    try:
+        return fn()
+    except Exception as e:
+        startup_errors[name] = str(e)
+        print(f"Startup step '{name}' failed:", e)
+        return None
+    finally:
+        startup_timings[name] = round(time.perf_counter() - started, 4)
+
+
+def _import_search_backend():
+    import duckduckgo_search  # noqa: F401
+
+
+def _load_corpus():
+    corpus.refresh()  # documents, BM25 and vector index
+    if not corpus.docs:
+        raise RuntimeError(f"no documents in {corpus.path}")
+
+
+def warm_up():
+    """Load the database, corpus, index, models and clients. Safe to call twice.
+
+    Nothing loads at import time: `python app.py` and the load test call
+    this, and under other servers the first request starts it (see
+    start_warm_up).
+    """
+    global intent_classifier
+    with _warm_up_lock:
+        if _warmed_up.is_set():
+            return
+        started = time.perf_counter()
+        _timed("db", init_user_db)
+        message_writer.start()
+        _timed("corpus", _load_corpus)
+        corpus.start_watcher()
+        model = corpus.vector.model if corpus.vector is not None else None
+        intent_classifier = _timed("intent_classifier", lambda: IntentClassifier.load(model))
+        response_cache.model = model
+        _timed("ollama_client", get_ollama_http)
+        _timed("web_search_backend", _import_search_backend)
+        startup_timings["warm_up_total"] = round(time.perf_counter() - started, 4)
+        _warmed_up.set()
+        print(
+            "Startup: "
+            + ", ".join(f"{k} {v:.2f}s" for k, v in startup_timings.items())
+        )
+        if not is_ready():
+            print("Startup incomplete, not ready:", startup_errors)
+
+
+def start_warm_up():
+    """Run warm_up() on a background thread, once."""
+    if _warm_up_started.acquire(blocking=False):
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+def is_ready() -> bool:
+    """Warm-up done with a working database and a non-empty corpus.
+
+    The corpus watcher can still load documents later, which makes the
+    service ready without a restart; a database failure does not recover.
+    """
+    return _warmed_up.is_set() and "db" not in startup_errors and bool(corpus.docs)
+
+
+# Pages and readiness probes never wait; API calls wait for warm-up to finish
+# rather than racing it with a cold index.
+_NO_WAIT_ENDPOINTS = {"ready", "metrics_endpoint", "static", "home", "chat_page"}
+
+
+@app.before_request
+def wait_until_ready():
+    if _warmed_up.is_set():
+        return None
+    start_warm_up()  # the first request (often the readiness probe) kicks it off
+    if request.endpoint in _NO_WAIT_ENDPOINTS:
+        return None
+    if not _warmed_up.wait(STARTUP_WAIT_SECONDS):
+        return jsonify({"error": "Service is starting, please retry shortly"}), 503
+    return None
+
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    """Readiness probe: 200 once warm-up has succeeded, 503 before or if it failed."""
+    ok = is_ready()
+    body = {
+        "ready": ok,
+        "components": {
+            "corpus_documents": len(corpus.docs),
+            "vector_index": corpus.vector is not None,
+            "intent_classifier": intent_classifier is not None,
+        },
+        "startup_seconds": startup_timings,
+        "errors": startup_errors,
+    }
+    return jsonify(body), 200 if ok else 503
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Prometheus text exposition: stage latencies, fallback/failure counters, gauges."""
+    gauges = {"bloom_ready": 1 if is_ready() else 0}
+    for key, value in response_cache.stats().items():
+        gauges[f"bloom_response_cache_{key}"] = value
+    for key, value in message_writer.stats().items():
+        gauges[f"bloom_message_writer_{key}"] = value
+    for key, value in startup_timings.items():
+        gauges[f"bloom_startup_{key}_seconds"] = value
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
+
+startup_timings["module_import"] = round(time.perf_counter() - _MODULE_STARTED, 4)
+
+
 if __name__ == "__main__":
+    warm_up()  # load everything before serving so the first request is warm
     app.run(host="127.0.0.1", port=5000, debug=False, use_reloader=False)
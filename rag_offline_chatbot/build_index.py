@@ -3,15 +3,40 @@ Build FAISS index from data/knowledge.md using sentence-transformers embeddings.
 
 Usage:
     python build_index.py
+    python build_index.py --source data/kb/     # every .md / .txt under a folder
+    python build_index.py --workers 4           # embed with 4 processes
 
 This will create:
 - data/embeddings.npy
 - data/documents.txt
 - data/faiss_index.idx
+- data/manifest.json   (content hash per chunk, for incremental rebuilds)
+
+Rebuilds are incremental: chunks whose text hash is already in the manifest
+reuse their stored vector; only new or edited chunks are embedded. Pass
+--full to re-embed everything.
+
+Ingestion streams: files are read line by line into paragraph chunks,
+embedded in fixed-size batches and written into a memory-mapped
+embeddings.npy, so memory stays flat however large the corpus is.
+Outputs are written to temporary files and swapped in at the end.
+
+Index types (--index): flat (exact, default), ivf, ivfpq, hnsw, pq. The
+choice and its search parameters are stored in manifest.json and applied
+by app.py at load time. To compare them on the current corpus:
+
+    python build_index.py --benchmark            # recall@k vs flat, p50/p99 latency
 
 Note: Requires sentence-transformers and faiss-cpu.
 """
 import os
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing as mp
+from collections import deque
+from itertools import islice
 from pathlib import Path
 import numpy as np
 
@@ -31,31 +56,367 @@ DATA_FILE = Path("data/knowledge.md")
 EMB_FILE = Path("data/embeddings.npy")
 DOCS_FILE = Path("data/documents.txt")
 INDEX_FILE = Path("data/faiss_index.idx")
+MANIFEST_FILE = Path("data/manifest.json")
+MODEL_NAME = os.getenv("EMBED_MODEL") or "all-MiniLM-L6-v2"
+DOC_SEP = "\n<<DOC_SEP>>\n"
+SOURCE_SUFFIXES = {".md", ".markdown", ".txt"}
+BATCH_SIZE = 64
+
+def iter_source_files(source):
+    """Yield the files to index: `source` itself, or every .md/.txt below it."""
+    source = Path(source)
+    if source.is_file():
+        yield source
+        return
+    for path in sorted(source.rglob("*")):
+        if path.is_file() and path.suffix.lower() in SOURCE_SUFFIXES:
+            yield path
+
+def iter_file_chunks(path):
+    # naive split: paragraphs by blank lines, read line by line
+    lines = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                lines.append(line.rstrip("\n"))
+            elif lines:
+                yield "\n".join(lines).strip()
+                lines = []
+    if lines:
+        yield "\n".join(lines).strip()
+
+def iter_chunks(source):
+    for path in iter_source_files(source):
+        yield from iter_file_chunks(path)
 
 def load_docs(path):
-    text = path.read_text(encoding="utf-8")
-    # naive split: paragraphs by blank lines
-    parts = [p.strip() for p in text.split("\n\n") if p.strip()]
-    return parts
-
-def build():
-    print("Loading documents...")
-    docs = load_docs(DATA_FILE)
-    print(f"{len(docs)} docs loaded.")
-    model = SentenceTransformer("all-MiniLM-L6-v2")
-    print("Computing embeddings...")
-    embeddings = model.encode(docs, show_progress_bar=True, convert_to_numpy=True)
-    print("Saving embeddings and docs...")
-    np.save(EMB_FILE, embeddings)
-    DOCS_FILE.write_text("\n<<DOC_SEP>>\n".join(docs), encoding="utf-8")
-    # build faiss index
-    d = embeddings.shape[1]
-    index = faiss.IndexFlatIP(d)  # use inner product on normalized vectors
-    # normalize vectors
-    faiss.normalize_L2(embeddings)
-    index.add(embeddings)
-    faiss.write_index(index, str(INDEX_FILE))
-    print("Index built and saved to", INDEX_FILE)
+    return list(iter_chunks(path))
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def batched(iterable, n):
+    it = iter(iterable)
+    while batch := list(islice(it, n)):
+        yield batch
+
+def file_sha256(path, block=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(block):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_previous():
+    """Return ({hash: row}, embeddings memmap) from the last build, or ({}, None).
+
+    The manifest records a digest of the embeddings file it describes, so a
+    build interrupted between file swaps is detected instead of reusing
+    vectors for the wrong chunks.
+    """
+    if not (MANIFEST_FILE.exists() and EMB_FILE.exists()):
+        return {}, None
+    try:
+        manifest = json.loads(MANIFEST_FILE.read_text(encoding="utf-8"))
+        embeddings = np.load(EMB_FILE, mmap_mode="r")
+    except Exception as e:
+        print("Ignoring previous build:", e)
+        return {}, None
+    hashes = manifest.get("chunks", [])
+    if (manifest.get("model") != MODEL_NAME or len(hashes) != len(embeddings)
+            or manifest.get("embeddings_sha256") != file_sha256(EMB_FILE)):
+        print("Previous build used a different model or is inconsistent; re-embedding all.")
+        return {}, None
+    return {h: i for i, h in enumerate(hashes)}, embeddings
+
+def _tmp(path):
+    return path.with_name(path.name + ".tmp")
+
+# ---------- index types ----------
+INDEX_TYPES = ("flat", "ivf", "ivfpq", "hnsw", "pq")
+TRAIN_SAMPLE_MAX = 100_000
+
+def _pq_m(d, requested=None):
+    """Number of PQ sub-quantizers: must divide d; default ~8 dims each."""
+    m = requested or max(1, d // 8)
+    while d % m:
+        m -= 1
+    return m
+
+def index_config(kind, n, d, nlist=None, nprobe=None, hnsw_m=32, ef_search=64, pq_m=None):
+    """Resolve defaults for an index type given the corpus size n and dim d."""
+    cfg = {"type": kind}
+    if kind in ("ivf", "ivfpq"):
+        # ~4*sqrt(n) lists, but keep >= 39 training points per centroid.
+        cfg["nlist"] = nlist or max(1, min(int(4 * np.sqrt(n)), n // 39))
+        cfg["nprobe"] = min(nprobe or max(1, cfg["nlist"] // 8), cfg["nlist"])
+    if kind == "hnsw":
+        cfg["hnsw_m"] = hnsw_m
+        cfg["ef_search"] = ef_search
+    if kind in ("ivfpq", "pq"):
+        cfg["pq_m"] = _pq_m(d, pq_m)
+        cfg["pq_bits"] = int(max(1, min(8, np.log2(max(n, 2)))))  # 2**bits <= n
+    return cfg
+
+def search_params(cfg):
+    """faiss ParameterSpace string for query-time settings, e.g. 'nprobe=8'."""
+    if "nprobe" in cfg:
+        return f"nprobe={cfg['nprobe']}"
+    if "ef_search" in cfg:
+        return f"efSearch={cfg['ef_search']}"
+    return ""
+
+def make_index(cfg, d):
+    kind = cfg["type"]
+    ip = faiss.METRIC_INNER_PRODUCT  # inner product on normalized vectors
+    if kind == "flat":
+        return faiss.IndexFlatIP(d)
+    if kind == "ivf":
+        return faiss.IndexIVFFlat(faiss.IndexFlatIP(d), d, cfg["nlist"], ip)
+    if kind == "ivfpq":
+        return faiss.IndexIVFPQ(faiss.IndexFlatIP(d), d, cfg["nlist"], cfg["pq_m"], cfg["pq_bits"], ip)
+    if kind == "hnsw":
+        index = faiss.IndexHNSWFlat(d, cfg["hnsw_m"], ip)
+        index.hnsw.efConstruction = max(40, 2 * cfg["hnsw_m"])
+        return index
+    if kind == "pq":
+        return faiss.IndexPQ(d, cfg["pq_m"], cfg["pq_bits"], ip)
+    raise ValueError(f"Unknown index type: {kind}")
+
+def fill_index(cfg, embeddings, step=4096):
+    """Train (on a sample) if needed, then add normalized vectors slice by slice."""
+    n, d = embeddings.shape
+    index = make_index(cfg, d)
+    if not index.is_trained:
+        rng = np.random.default_rng(0)
+        rows = np.sort(rng.choice(n, size=min(n, TRAIN_SAMPLE_MAX), replace=False))
+        sample = np.array(embeddings[rows], dtype=np.float32)
+        faiss.normalize_L2(sample)
+        index.train(sample)
+    for start in range(0, n, step):
+        part = np.array(embeddings[start:start + step], dtype=np.float32)
+        # normalize vectors
+        faiss.normalize_L2(part)
+        index.add(part)
+    params = search_params(cfg)
+    if params:
+        faiss.ParameterSpace().set_index_parameters(index, params)
+    return index
+
+# ---------- embedding (in-process or across worker processes) ----------
+_worker_model = None
+
+def _init_worker(model_name, threads):
+    """Pool initializer: load the model once per worker process."""
+    global _worker_model
+    try:
+        import torch
+        torch.set_num_threads(threads)  # avoid oversubscribing cores across workers
+    except Exception:
+        pass
+    _worker_model = SentenceTransformer(model_name)
+
+def _embed_worker(texts, batch_size):
+    started = time.perf_counter()
+    vecs = _worker_model.encode(texts, batch_size=batch_size, convert_to_numpy=True)
+    return os.getpid(), vecs.astype(np.float32), time.perf_counter() - started
+
+def iter_embedded(batches, workers, batch_size, stats):
+    """Yield (batch, new_positions, vectors for those positions) in source order.
+
+    `batches` yields (texts, new_positions). With workers > 1 the new texts
+    are sharded across a process pool; at most 2*workers batches are in
+    flight, so memory stays bounded and results are merged in order.
+    stats collects {pid: [chunks, seconds]}.
+    """
+    if workers <= 1:
+        model = None
+        for texts, new in batches:
+            vecs = None
+            if new:
+                model = model or SentenceTransformer(MODEL_NAME)
+                started = time.perf_counter()
+                vecs = model.encode([texts[j] for j in new], batch_size=batch_size,
+                                    convert_to_numpy=True).astype(np.float32)
+                s = stats.setdefault(os.getpid(), [0, 0.0])
+                s[0] += len(new)
+                s[1] += time.perf_counter() - started
+            yield texts, new, vecs
+        return
+
+    threads = max(1, (os.cpu_count() or workers) // workers)
+    ctx = mp.get_context("spawn")  # fork + torch threads can deadlock
+    with ctx.Pool(workers, initializer=_init_worker, initargs=(MODEL_NAME, threads)) as pool:
+        pending = deque()
+
+        def drain_one():
+            texts, new, job = pending.popleft()
+            vecs = None
+            if job is not None:
+                pid, vecs, seconds = job.get()
+                s = stats.setdefault(pid, [0, 0.0])
+                s[0] += len(new)
+                s[1] += seconds
+            return texts, new, vecs
+
+        for texts, new in batches:
+            job = (pool.apply_async(_embed_worker, ([texts[j] for j in new], batch_size))
+                   if new else None)
+            pending.append((texts, new, job))
+            if len(pending) >= 2 * workers:
+                yield drain_one()
+        while pending:
+            yield drain_one()
+
+def build(source=DATA_FILE, full=False, batch_size=BATCH_SIZE, index_type="flat",
+          index_opts=None, workers=1):
+    print(f"Scanning {source}...")
+    # Pass 1: hash every chunk (cheap, streaming) to size the output and plan reuse.
+    hashes = [chunk_hash(c) for c in iter_chunks(source)]
+    if not hashes:
+        print("No documents to index.")
+        return
+    prev_rows, prev_emb = ({}, None) if full else load_previous()
+    todo = sum(1 for h in hashes if h not in prev_rows)
+    print(f"{len(hashes)} docs found: {len(hashes) - todo} chunks reused, {todo} to embed, "
+          f"{len(set(prev_rows) - set(hashes))} dropped.")
+    workers = max(1, min(workers, -(-todo // batch_size))) if todo else 1
+    if workers > 1:
+        print(f"Embedding with {workers} worker processes...")
+
+    def plan():
+        done = 0
+        for batch in batched(iter_chunks(source), batch_size):
+            batch_hashes = [chunk_hash(c) for c in batch]
+            if batch_hashes != hashes[done:done + len(batch)]:
+                raise RuntimeError("Source files changed during the build; re-run build_index.py.")
+            done += len(batch)
+            yield batch, [j for j, h in enumerate(batch_hashes) if h not in prev_rows]
+
+    # Pass 2: embed in batches straight into a memory-mapped .npy.
+    # The file is created once the dimension is known (previous build or first batch).
+    emb_tmp, docs_tmp = _tmp(EMB_FILE), _tmp(DOCS_FILE)
+    d = prev_emb.shape[1] if prev_emb is not None else None
+    embeddings = None
+    stats = {}
+    started = time.perf_counter()
+    done = embedded = 0
+    with open(docs_tmp, "w", encoding="utf-8") as docs_out:
+        for batch, new, new_vecs in iter_embedded(plan(), workers, batch_size, stats):
+            if d is None:
+                d = new_vecs.shape[1]
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(
+                    emb_tmp, mode="w+", dtype=np.float32, shape=(len(hashes), d)
+                )
+            vecs = np.empty((len(batch), d), dtype=np.float32)
+            fresh = iter(new_vecs if new_vecs is not None else ())
+            new_set = set(new)
+            for j in range(len(batch)):
+                vecs[j] = next(fresh) if j in new_set else prev_emb[prev_rows[hashes[done + j]]]
+            embeddings[done:done + len(batch)] = vecs
+            for text in batch:
+                docs_out.write((DOC_SEP if done else "") + text)
+                done += 1
+            embedded += len(new)
+            elapsed = time.perf_counter() - started
+            print(f"  {done}/{len(hashes)} chunks, {embedded} embedded "
+                  f"({embedded / elapsed if elapsed else 0:.1f} chunks/s)", flush=True)
+    for pid, (count, seconds) in sorted(stats.items()):
+        print(f"  worker {pid}: {count} chunks in {seconds:.1f}s "
+              f"({count / seconds if seconds else 0:.1f} chunks/s)")
+    embeddings.flush()
+
+    cfg = index_config(index_type, len(hashes), d, **(index_opts or {}))
+    print(f"Building {index_type} index {cfg}...")
+    index = fill_index(cfg, embeddings)
+    del embeddings, prev_emb
+    index_tmp = _tmp(INDEX_FILE)
+    faiss.write_index(index, str(index_tmp))
+    manifest_tmp = _tmp(MANIFEST_FILE)
+    manifest_tmp.write_text(
+        json.dumps(
+            {"model": MODEL_NAME, "dim": int(d),
+             "index": dict(cfg, search_params=search_params(cfg)),
+             "embeddings_sha256": file_sha256(emb_tmp), "chunks": hashes},
+            indent=1,
+        ),
+        encoding="utf-8",
+    )
+
+    print("Saving embeddings, index, manifest and docs...")
+    # Every file is written before any is swapped in. Swap the docs file last
+    # so a running app never pairs new docs with an old index.
+    os.replace(emb_tmp, EMB_FILE)
+    os.replace(index_tmp, INDEX_FILE)
+    os.replace(manifest_tmp, MANIFEST_FILE)
+    os.replace(docs_tmp, DOCS_FILE)
+    total = time.perf_counter() - started
+    print(f"Index built and saved to {INDEX_FILE} "
+          f"({len(hashes)} chunks in {total:.1f}s, {embedded} embedded)")
+
+def benchmark(k=5, queries=200, types=INDEX_TYPES, index_opts=None):
+    """Compare index types on the built corpus: recall@k vs flat and query latency.
+
+    Queries are a random sample of the corpus's own chunk vectors.
+    """
+    if not EMB_FILE.exists():
+        print("No embeddings found. Run build_index.py first.")
+        return
+    embeddings = np.load(EMB_FILE, mmap_mode="r")
+    n, d = embeddings.shape
+    rng = np.random.default_rng(1)
+    q = np.array(embeddings[np.sort(rng.choice(n, size=min(queries, n), replace=False))],
+                 dtype=np.float32)
+    faiss.normalize_L2(q)
+    k = min(k, n)
+    truth = None
+    print(f"{n} chunks, dim {d}, {len(q)} queries, k={k}")
+    print(f"{'index':<8} {'recall@k':>9} {'p50 ms':>8} {'p99 ms':>8} {'build s':>8} {'size MB':>8}  params")
+    for kind in ["flat"] + [t for t in types if t != "flat"]:
+        cfg = index_config(kind, n, d, **(index_opts or {}))
+        t0 = time.perf_counter()
+        index = fill_index(cfg, embeddings)
+        build_s = time.perf_counter() - t0
+        found, lat = [], []
+        for row in q:
+            t0 = time.perf_counter()
+            _, ids = index.search(row[None, :], k)
+            lat.append((time.perf_counter() - t0) * 1000)
+            found.append(ids[0])
+        found = np.array(found)
+        if truth is None:
+            truth = found  # flat is exact: the reference result
+        recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(found, truth)])
+        size_mb = faiss.serialize_index(index).nbytes / 1e6
+        print(f"{kind:<8} {recall:>9.3f} {np.percentile(lat, 50):>8.3f} {np.percentile(lat, 99):>8.3f} "
+              f"{build_s:>8.2f} {size_mb:>8.2f}  {search_params(cfg)}")
 
 if __name__ == "__main__":
-    build()
+    parser = argparse.ArgumentParser(description="Build the FAISS index from data/knowledge.md")
+    parser.add_argument("--source", default=str(DATA_FILE),
+                        help="markdown/text file or directory to index (default: %(default)s)")
+    parser.add_argument("--full", action="store_true", help="re-embed every chunk")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="chunks per embedding batch (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="embedding processes, each loading the model once (default: %(default)s)")
+    parser.add_argument("--index", choices=INDEX_TYPES, default="flat",
+                        help="FAISS index type (default: %(default)s)")
+    parser.add_argument("--nlist", type=int, help="IVF lists (default ~4*sqrt(n))")
+    parser.add_argument("--nprobe", type=int, help="IVF lists probed per query")
+    parser.add_argument("--hnsw-m", type=int, default=32, help="HNSW neighbours per node")
+    parser.add_argument("--ef-search", type=int, default=64, help="HNSW search depth")
+    parser.add_argument("--pq-m", type=int, help="PQ sub-quantizers (must divide dim)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="compare index types on the built embeddings instead of building")
+    parser.add_argument("--k", type=int, default=5, help="benchmark: neighbours per query")
+    parser.add_argument("--queries", type=int, default=200, help="benchmark: number of queries")
+    args = parser.parse_args()
+    opts = {"nlist": args.nlist, "nprobe": args.nprobe, "hnsw_m": args.hnsw_m,
+            "ef_search": args.ef_search, "pq_m": args.pq_m}
+    if args.benchmark:
+        benchmark(k=args.k, queries=args.queries, index_opts=opts)
+    else:
+        build(source=args.source, full=args.full, batch_size=args.batch_size,
+              index_type=args.index, index_opts=opts, workers=args.workers)
@@ -0,0 +1,374 @@
+"""
+Offline load test for the chat backend.
+
+Starts a stub Ollama server (mimics /api/generate, streaming and not, with
+configurable prefill cost and token rate, and Ollama's prompt-prefix KV
+reuse in raw mode), swaps in a stub web-search
+backend, serves app.py on a local port and drives /chat (or /chat/stream)
+with concurrent simulated users sending a realistic mix of messages.
+
+Usage:
+    python loadtest.py
+    python loadtest.py --users 32 --requests 1000 --ollama-latency 0.8 --token-rate 25
+    python loadtest.py --stream --json results.json
+
+Reports throughput, p50/p95/p99 latency per message kind (and time to
+first token with --stream), LLM calls made, response-cache hits and
+SQLite write contention from the message writer. Needs no network, no
+Ollama and no index build.
+"""
+import os
+import sys
+import json
+import math
+import logging
+import random
+import tempfile
+import argparse
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# kind -> (weight, messages). "playbook" messages have an offline playbook
+# reply, which the app uses when the stub returns a failed or short generation.
+MESSAGE_MIX = {
+    "crisis": (0.05, [
+        "I want to end my life",
+        "I keep thinking about suicide",
+        "sometimes I want to hurt myself",
+    ]),
+    "playbook": (0.25, [
+        "I can't sleep at night, what to do",
+        "how to handle social anxiety at work",
+        "I have trouble sleeping before exams",
+        "ptsd flashbacks keep coming back",
+        "I'm scared of being judged for my weight",
+    ]),
+    "rag": (0.5, [
+        "I feel lonely and sad",
+        "how do I stop overthinking",
+        "I'm anxious about my exams",
+        "breathing exercises for stress",
+        "I feel empty and tired all the time",
+        "my friends ignore me and it hurts",
+        "I feel overwhelmed with work",
+    ]),
+    "web": (0.2, [
+        "latest news on anxiety treatment",
+        "what are the symptoms of burnout",
+        "current advice on sleep and mental health",
+        "what causes panic attacks",
+    ]),
+}
+
+STUB_REPLY = (
+    "That sounds really difficult, and it makes sense you feel this way.\n"
+    "- Try slow breathing: in for 4, hold for 4, out for 6.\n"
+    "- Take a short walk or stretch for five minutes.\n"
+    "- Write down the worry and one small next step.\n"
+    "- Reach out to someone you trust today.\n"
+    "Be gentle with yourself."
+)
+
+
+# ---------- stub Ollama ----------
+class StubOllama:
+    """Threaded HTTP server answering /api/generate like a local Ollama."""
+
+    def __init__(self, latency, token_rate, bad_rate=0.0, error_rate=0.0, prefill_rate=0.0):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.prefill_rate = prefill_rate
+        self.bad_rate = bad_rate
+        self.error_rate = error_rate
+        self.calls = 0
+        self.prefill_tokens = 0
+        self.reused_tokens = 0
+        self._recent = deque(maxlen=4)  # word lists of the last prompts (KV cache slots)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with stub._lock:
+                    stub.calls += 1
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                try:
+                    stub.respond(self, body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # client stopped reading (stop marker / deadline)
+                finally:
+                    with stub._lock:
+                        stub.in_flight -= 1
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}/api/generate"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def respond(self, handler, body):
+        # Prefill: fixed latency plus per prompt token not shared with a
+        # recent prompt's prefix, like Ollama reusing a slot's KV cache.
+        # Raw mode neither accepts nor returns `context`.
+        prompt_words = body["prompt"].split()
+        with self._lock:
+            shared = max((_common_prefix(prompt_words, w) for w in self._recent), default=0)
+            self._recent.append(prompt_words)
+            prompt_tokens = int((len(prompt_words) - shared) * 1.3) + 1
+            self.prefill_tokens += prompt_tokens
+            self.reused_tokens += int(shared * 1.3)
+        started = time.perf_counter()
+        time.sleep(self.latency + (prompt_tokens / self.prefill_rate if self.prefill_rate > 0 else 0))
+        prefill_ns = int((time.perf_counter() - started) * 1e9)
+        if random.random() < self.error_rate:
+            handler.send_response(500)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+        if "You are a classifier" in body["prompt"]:
+            text = random.choice(["therapy", "general", "medical"])
+        elif random.random() < self.bad_rate:
+            text = "ok."
+        else:
+            text = STUB_REPLY
+        words = text.split(" ")
+        tokens = [w + " " for w in words[:-1]] + [words[-1]]
+        per_token = 1.0 / self.token_rate if self.token_rate > 0 else 0.0
+        final = {
+            "done": True,
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": prefill_ns,
+        }
+
+        if not body.get("stream"):
+            time.sleep(per_token * len(tokens))
+            data = json.dumps(dict(final, response=text)).encode()
+            handler.send_response(200)
+            handler.send_header("Content-Type", "application/json")
+            handler.send_header("Content-Length", str(len(data)))
+            handler.end_headers()
+            handler.wfile.write(data)
+            return
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/x-ndjson")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+
+        def chunk(obj):
+            line = (json.dumps(obj) + "\n").encode()
+            handler.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+            handler.wfile.flush()
+
+        for tok in tokens:
+            time.sleep(per_token)
+            chunk({"response": tok, "done": False})
+        chunk(dict(final, response=""))
+        handler.wfile.write(b"0\r\n\r\n")
+
+
+def _common_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+# ---------- stub web search ----------
+def make_search_stub(latency):
+    calls = {"n": 0}
+
+    def backend(query, max_results):
+        calls["n"] += 1
+        time.sleep(latency)
+        return [
+            {"title": f"Result {i} for {query}", "body": "Offline stub search snippet."}
+            for i in range(max_results)
+        ]
+
+    return backend, calls
+
+
+# ---------- load generator ----------
+def pick_message(rng, repeat_rate):
+    kinds = list(MESSAGE_MIX)
+    kind = rng.choices(kinds, weights=[MESSAGE_MIX[k][0] for k in kinds])[0]
+    msg = rng.choice(MESSAGE_MIX[kind][1])
+    if rng.random() >= repeat_rate:
+        # Unique suffix: defeats the response cache like real, varied wording.
+        msg = f"{msg} ({rng.randint(0, 10**9)})"
+    return kind, msg
+
+
+def run_user(base, user_no, args, counter, results, lock):
+    rng = random.Random(args.seed + user_no)
+    http = requests.Session()
+    r = http.post(f"{base}/register",
+                  json={"username": f"load{user_no}_{rng.randint(0, 10**9)}", "password": "pw"})
+    r.raise_for_status()
+    path = "/chat/stream" if args.stream else "/chat"
+    turns = 0
+    while True:
+        with lock:
+            if counter["sent"] >= args.requests:
+                return
+            counter["sent"] += 1
+        if turns >= args.turns:
+            http.post(f"{base}/conversations", json={"title": "Load"}).raise_for_status()
+            turns = 0
+        turns += 1
+        kind, msg = pick_message(rng, args.repeat_rate)
+        started = time.perf_counter()
+        ttft = None
+        ok = False
+        try:
+            resp = http.post(f"{base}{path}", json={"message": msg},
+                             stream=args.stream, timeout=args.timeout)
+            if args.stream:
+                for piece in resp.iter_content(chunk_size=None):
+                    if ttft is None and piece:
+                        ttft = time.perf_counter() - started
+            else:
+                resp.content
+            ok = resp.status_code == 200
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            results.append((kind, elapsed, ttft, ok))
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(rows):
+    lat = [r[1] for r in rows if r[3]]
+    out = {
+        "requests": len(rows),
+        "errors": sum(1 for r in rows if not r[3]),
+        "p50_ms": round(percentile(lat, 50) * 1000, 1),
+        "p95_ms": round(percentile(lat, 95) * 1000, 1),
+        "p99_ms": round(percentile(lat, 99) * 1000, 1),
+    }
+    ttft = [r[2] for r in rows if r[3] and r[2] is not None]
+    if ttft:
+        out["ttft_p50_ms"] = round(percentile(ttft, 50) * 1000, 1)
+        out["ttft_p99_ms"] = round(percentile(ttft, 99) * 1000, 1)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for /chat")
+    parser.add_argument("--users", type=int, default=16, help="concurrent simulated users")
+    parser.add_argument("--requests", type=int, default=300, help="total chat messages")
+    parser.add_argument("--stream", action="store_true", help="use /chat/stream and report TTFT")
+    parser.add_argument("--ollama-latency", type=float, default=0.3,
+                        help="stub fixed per-call latency (seconds)")
+    parser.add_argument("--prefill-rate", type=float, default=400,
+                        help="stub prompt tokens prefilled per second (0 = free)")
+    parser.add_argument("--token-rate", type=float, default=60, help="stub tokens per second")
+    parser.add_argument("--bad-rate", type=float, default=0.1,
+                        help="share of stub generations that are too short (playbook path)")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="share of stub HTTP 500s")
+    parser.add_argument("--search-latency", type=float, default=0.2, help="stub web search seconds")
+    parser.add_argument("--repeat-rate", type=float, default=0.3,
+                        help="share of messages sent verbatim (cacheable)")
+    parser.add_argument("--turns", type=int, default=3,
+                        help="messages per conversation before a user starts a new one")
+    parser.add_argument("--timeout", type=float, default=120, help="client timeout per request")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    stub = StubOllama(args.ollama_latency, args.token_rate, args.bad_rate, args.error_rate,
+                      args.prefill_rate).start()
+    db_dir = tempfile.mkdtemp(prefix="bloom-load-")
+    # app.py reads these at import time.
+    os.environ["OLLAMA_URL"] = stub.url
+    os.environ["USER_DB"] = os.path.join(db_dir, "users.db")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as chat_app
+    from werkzeug.serving import make_server
+
+    chat_app.warm_up()
+    search_backend, search_calls = make_search_stub(args.search_latency)
+    chat_app.web_searcher.backend = search_backend
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, chat_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.socket.getsockname()[1]}"
+
+    print(f"Driving {base} with {args.users} users, {args.requests} requests "
+          f"({'stream' if args.stream else 'json'})...")
+    results, counter, lock = [], {"sent": 0}, threading.Lock()
+    started = time.perf_counter()
+    users = [threading.Thread(target=run_user, args=(base, i, args, counter, results, lock))
+             for i in range(args.users)]
+    for t in users:
+        t.start()
+    for t in users:
+        t.join()
+    wall = time.perf_counter() - started
+    chat_app.message_writer.flush()
+
+    by_kind = defaultdict(list)
+    for row in results:
+        by_kind[row[0]].append(row)
+    report = {
+        "config": vars(args),
+        "wall_seconds": round(wall, 2),
+        "throughput_rps": round(len(results) / wall, 2) if wall else 0.0,
+        "overall": summarize(results),
+        "by_kind": {k: summarize(v) for k, v in sorted(by_kind.items())},
+        "llm_calls": stub.calls,
+        "llm_max_in_flight": stub.max_in_flight,
+        "llm_prefill_tokens": stub.prefill_tokens,
+        "llm_reused_prefix_tokens": stub.reused_tokens,
+        "search_calls": search_calls["n"],
+        "response_cache": chat_app.response_cache.stats(),
+        "sqlite_writer": chat_app.message_writer.stats(),
+    }
+
+    print(f"\n{len(results)} requests in {wall:.1f}s -> {report['throughput_rps']} req/s")
+    cols = ["requests", "errors", "p50_ms", "p95_ms", "p99_ms"]
+    if args.stream:
+        cols += ["ttft_p50_ms", "ttft_p99_ms"]
+    print(f"{'kind':<10}" + "".join(f"{c:>13}" for c in cols))
+    for name, row in [("all", report["overall"])] + list(report["by_kind"].items()):
+        print(f"{name:<10}" + "".join(f"{row.get(c, ''):>13}" for c in cols))
+    print(f"\nLLM calls: {stub.calls} (max {stub.max_in_flight} in flight, "
+          f"{stub.prefill_tokens} prompt tokens prefilled, {stub.reused_tokens} reused from "
+          f"cached prefixes), search calls: {search_calls['n']}")
+    print("Response cache:", report["response_cache"])
+    print("SQLite writer:", report["sqlite_writer"])
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print("Report written to", args.json)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
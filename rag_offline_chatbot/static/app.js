@@ -58,7 +58,7 @@ document.addEventListener("DOMContentLoaded", () => {
     return now.toLocaleTimeString([], { hour: "2-digit", minute: "2-digit" });
   }
 
-  function appendMessage(text, who = "bot") {
+  function buildMessage(text, who = "bot") {
     const wrapper = document.createElement("div");
     wrapper.className = "msg-wrap";
 
@@ -82,8 +82,15 @@ document.addEventListener("DOMContentLoaded", () => {
       msg.appendChild(react);
     }
 
+    return wrapper;
+  }
+
+  function appendMessage(text, who = "bot") {
+    const wrapper = buildMessage(text, who);
     chat.appendChild(wrapper);
     chat.scrollTop = chat.scrollHeight;
+    // text node container, for streaming updates
+    return wrapper.querySelector(".message").firstElementChild;
   }
 
   function typingBubble() {
@@ -112,13 +119,37 @@ document.addEventListener("DOMContentLoaded", () => {
   }
 
   // ---------- History ----------
+  // /history is keyset-paginated: the latest page on open, older pages
+  // (before_id) when scrolled to the top, newer rows (after_id) on refocus.
+  let oldestId = null;
+  let newestId = null;
+  let hasOlder = false;
+  let loadingOlder = false;
+  let sentSinceSync = false; // locally rendered messages have no ids yet
+
+  function trackIds(messages) {
+    messages.forEach((m) => {
+      if (oldestId === null || m.id < oldestId) oldestId = m.id;
+      if (newestId === null || m.id > newestId) newestId = m.id;
+    });
+  }
+
+  async function fetchHistory(params) {
+    const res = await fetch("/history?" + new URLSearchParams(params));
+    if (!res.ok) return null;
+    return res.json();
+  }
+
   async function loadHistory() {
     try {
-      const res = await fetch("/history");
-      if (!res.ok) return;
-      const data = await res.json();
+      const data = await fetchHistory({});
+      if (!data) return;
       clearChat();
-      (data.messages || []).forEach((m) =>
+      oldestId = newestId = null;
+      const msgs = data.messages || [];
+      trackIds(msgs);
+      hasOlder = !!data.has_more;
+      msgs.forEach((m) =>
         appendMessage(m.content, m.role === "user" ? "user" : "bot")
       );
     } catch (err) {
@@ -126,6 +157,52 @@ document.addEventListener("DOMContentLoaded", () => {
     }
   }
 
+  async function loadOlderHistory() {
+    if (!hasOlder || loadingOlder || oldestId === null) return;
+    loadingOlder = true;
+    try {
+      const data = await fetchHistory({ before_id: oldestId });
+      if (!data) return;
+      const msgs = data.messages || [];
+      trackIds(msgs);
+      hasOlder = !!data.has_more;
+      // Prepend without jumping: keep the same content under the viewport.
+      const prevHeight = chat.scrollHeight;
+      const frag = document.createDocumentFragment();
+      msgs.forEach((m) =>
+        frag.appendChild(buildMessage(m.content, m.role === "user" ? "user" : "bot"))
+      );
+      chat.insertBefore(frag, chat.firstChild);
+      chat.scrollTop += chat.scrollHeight - prevHeight;
+    } catch (err) {
+      console.error("history error", err);
+    } finally {
+      loadingOlder = false;
+    }
+  }
+
+  async function loadNewerHistory() {
+    if (sentSinceSync || newestId === null) {
+      sentSinceSync = false;
+      await loadHistory();
+      return;
+    }
+    try {
+      let data;
+      do {
+        data = await fetchHistory({ after_id: newestId });
+        if (!data) return;
+        const msgs = data.messages || [];
+        trackIds(msgs);
+        msgs.forEach((m) =>
+          appendMessage(m.content, m.role === "user" ? "user" : "bot")
+        );
+      } while (data.has_more);
+    } catch (err) {
+      console.error("history error", err);
+    }
+  }
+
   // ---------- Auth flow ----------
   function showChatAfterAuth() {
     if (!authPanel) return;
@@ -218,13 +295,14 @@ document.addEventListener("DOMContentLoaded", () => {
     if (!text) return;
 
     appendMessage(text, "user");
+    sentSinceSync = true;
     msgInput.value = "";
     try { sendSound.play(); } catch (_) {}
 
     const typing = typingBubble();
 
     try {
-      const res = await fetch("/chat", {
+      const res = await fetch("/chat/stream", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify({ message: text }),
@@ -245,9 +323,14 @@ document.addEventListener("DOMContentLoaded", () => {
         return;
       }
 
-      const data = await res.json();
-      typing.remove();
-      appendMessage(data.reply, "bot");
+      if (!res.ok || !res.body) {
+        const data = await res.json();
+        typing.remove();
+        appendMessage(data.reply, "bot");
+        return;
+      }
+
+      await readReplyStream(res, typing);
     } catch (err) {
       console.error(err);
       typing.remove();
@@ -255,6 +338,57 @@ document.addEventListener("DOMContentLoaded", () => {
     }
   }
 
+  // Render Server-Sent Events from /chat/stream as they arrive.
+  // "token" events append to a draft bubble; "done" replaces it with the final reply.
+  async function readReplyStream(res, typing) {
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let bubble = null;
+    let draft = "";
+
+    const ensureBubble = () => {
+      if (!bubble) {
+        typing.remove();
+        bubble = appendMessage("", "bot");
+      }
+      return bubble;
+    };
+
+    const handle = (event, data) => {
+      if (event === "token") {
+        draft += data.text || "";
+        ensureBubble().textContent = draft;
+        chat.scrollTop = chat.scrollHeight;
+      } else if (event === "done") {
+        ensureBubble().textContent = data.reply || draft;
+        chat.scrollTop = chat.scrollHeight;
+      }
+    };
+
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      let sep;
+      while ((sep = buffer.indexOf("\n\n")) !== -1) {
+        const raw = buffer.slice(0, sep);
+        buffer = buffer.slice(sep + 2);
+        let event = "message";
+        let payload = "";
+        raw.split("\n").forEach((line) => {
+          if (line.startsWith("event:")) event = line.slice(6).trim();
+          else if (line.startsWith("data:")) payload += line.slice(5).trim();
+        });
+        if (payload) handle(event, JSON.parse(payload));
+      }
+    }
+    if (!bubble) {
+      typing.remove();
+      appendMessage("Something went wrong talking to the server.", "bot");
+    }
+  }
+
   // ---------- Listeners ----------
   if (loginBtn) loginBtn.addEventListener("click", doLogin);
   if (registerBtn) registerBtn.addEventListener("click", doRegister);
@@ -286,6 +420,18 @@ document.addEventListener("DOMContentLoaded", () => {
     };
   }
 
+  if (chat) {
+    chat.addEventListener("scroll", () => {
+      if (chat.scrollTop < 40) loadOlderHistory();
+    });
+  }
+
+  document.addEventListener("visibilitychange", () => {
+    if (document.visibilityState === "visible" && !chat.classList.contains("hidden")) {
+      loadNewerHistory();
+    }
+  });
+
   if (themeToggle) {
     themeToggle.onclick = () => document.body.classList.toggle("dark");
   }